@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+
+import boto3
+import base64
+from botocore.exceptions import ClientError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# base url of the FactSet API; point it to a local stand-in for testing
+FACTSET_API_BASE_URL=os.environ.get('FACTSET_API_BASE_URL','https://api.factset.com')
+
+# credentials are re-read from Secrets Manager after this many seconds
+SECRET_CACHE_TTL=int(os.environ.get('FACTSET_SECRET_CACHE_TTL','900'))
+
+# size of the connection pool shared by all handlers in this process
+HTTP_POOL_SIZE=int(os.environ.get('FACTSET_HTTP_POOL_SIZE','32'))
+
+# directory of the persistent caches; /tmp is the only writable location in a lambda
+CACHE_DIR=os.environ.get('FACTSET_CACHE_DIR',tempfile.gettempdir())
+
+
+class TTLCache:
+    # thread safe dictionary with a time to live per entry; the oldest entries
+    # are evicted once max_size is reached
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl=ttl
+        self.max_size=max_size
+        self.lock=threading.Lock()
+        self.entries={}
+
+    def get(self, key):
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        # ttl overrides the time to live of the cache for this entry
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.max_size:
+                # dictionaries keep insertion order, i.e. the first key is the oldest
+                del self.entries[next(iter(self.entries))]
+            self.entries[key]=(time.time()+(self.ttl if ttl is None else ttl), value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class PersistentTTLCache:
+    # TTLCache backed by a local sqlite database; entries survive a restart of the
+    # process and are shared by all processes on the same host. Values are stored
+    # as json
+
+    def __init__(self, name, ttl, max_size=10000):
+        self.ttl=ttl
+        self.memory=TTLCache(ttl, max_size)
+        self.path=os.path.join(CACHE_DIR, 'factset_'+name+'.sqlite')
+        self.lock=threading.Lock()
+        self.connection=None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection=sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self.connection.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key):
+        value=self.memory.get(key)
+        if value is not None:
+            return value
+        try:
+            with self.lock:
+                row=self.connect().execute('SELECT expires, value FROM cache WHERE key=?', (key,)).fetchone()
+        except sqlite3.Error:
+            # the persistent store is an optimization only
+            return None
+        if row is None or row[0] < time.time():
+            return None
+        value=json.loads(row[1])
+        # the entry expires in memory when it expires on disk, not a full ttl later
+        self.memory.put(key, value, row[0]-time.time())
+        return value
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        # store all (key, value) pairs in one transaction
+        expires=time.time()+self.ttl
+        for key, value in items:
+            self.memory.put(key, value)
+        try:
+            with self.lock:
+                connection=self.connect()
+                connection.executemany('INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?,?,?)',
+                    [(key, expires, json.dumps(value)) for key, value in items])
+                connection.commit()
+        except sqlite3.Error:
+            pass
+
+
+# process wide caches; they survive between invocations of a warm lambda
+# container and are shared by all requests of the gateway server
+_secret_cache=TTLCache(SECRET_CACHE_TTL, max_size=1)
+_session_lock=threading.Lock()
+_session=None
+_session_auth=None
+
+
+def api_url(path):
+    return FACTSET_API_BASE_URL+path
+
+
+def get_secret():
+
+    secret=_secret_cache.get('secret')
+    if secret is not None:
+        return secret
+
+    # credentials provided by the environment take precedence, e.g. when the
+    # handlers are hosted by the gateway server outside of AWS
+    if os.environ.get('FACTSET_API_USER') and os.environ.get('FACTSET_API_KEY'):
+        secret=json.dumps({'APIUser': os.environ['FACTSET_API_USER'], 'APIKey': os.environ['FACTSET_API_KEY']})
+        _secret_cache.put('secret', secret)
+        return secret
+
+    secret_name = "FactsetAPICredentials"
+    region_name = "us-west-1"
+
+    # Create a Secrets Manager client
+    session = boto3.session.Session()
+    client = session.client(
+        service_name='secretsmanager',
+        region_name=region_name
+    )
+
+    # In this sample we only handle the specific exceptions for the 'GetSecretValue' API.
+    # See https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
+    # We rethrow the exception by default.
+
+    try:
+        get_secret_value_response = client.get_secret_value(
+            SecretId=secret_name
+        )
+    except ClientError as e:
+        # DecryptionFailureException, InternalServiceErrorException, InvalidParameterException,
+        # InvalidRequestException and ResourceNotFoundException are all passed on to the caller
+        raise e
+    else:
+        # Decrypts secret using the associated KMS CMK.
+        # Depending on whether the secret is a string or binary, one of these fields will be populated.
+        if 'SecretString' in get_secret_value_response:
+            secret = get_secret_value_response['SecretString']
+        else:
+            secret = base64.b64decode(get_secret_value_response['SecretBinary']).decode('utf-8')
+
+    _secret_cache.put('secret', secret)
+    return secret
+
+
+def get_session(secret):
+    # return the process wide session; connections are pooled and reused
+    # across invocations and concurrent requests
+    global _session, _session_auth
+
+    auth=(secret['APIUser'],secret['APIKey'])
+    with _session_lock:
+        if _session is None or _session_auth != auth:
+            session=requests.Session()
+            adapter=HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.auth=auth
+            _session=session
+            _session_auth=auth
+        return _session
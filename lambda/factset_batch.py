@@ -0,0 +1,77 @@
+import json
+
+from array import array
+
+
+class Batch:
+    # Columnar representation of the rows of an external function batch. Input
+    # values, output fields and the API response of every row are kept in one list
+    # per column; the per row objects of the Snowflake result format
+    #    {"data": [[row_number, [{...}]], ...]}
+    # are only created one at a time while the batch is serialized.
+
+    __slots__=('row_numbers', 'col_names', 'columns', 'fields', 'constants', 'responses')
+
+    def __init__(self, col_names):
+        self.row_numbers=array('q')
+        self.col_names=col_names
+        # input values by column name
+        self.columns=[[] for name in col_names]
+        # output fields set for individual rows by field name
+        self.fields={}
+        # output fields with the same value for every row
+        self.constants={}
+        # API response object of every row; rows without a response are None
+        self.responses=[]
+
+    @classmethod
+    def from_rows(cls, rows, col_names):
+        # rows are [row_number, value, value, ...]; values beyond col_names are ignored
+        batch=cls(col_names)
+        column_count=len(col_names)
+        for row in rows:
+            batch.row_numbers.append(row[0])
+            for i in range(0,column_count):
+                batch.columns[i].append(row[i+1] if i+1 < len(row) else None)
+        batch.responses=[None]*len(rows)
+        return batch
+
+    def __len__(self):
+        return len(self.row_numbers)
+
+    def values(self, index):
+        # input values of a row, in the order of col_names
+        return [column[index] for column in self.columns]
+
+    def set(self, index, name, value):
+        field=self.fields.get(name)
+        if field is None:
+            field=self.fields[name]=[None]*len(self.row_numbers)
+        field[index]=value
+
+    def set_all(self, name, value):
+        self.constants[name]=value
+
+    def output_row(self, index):
+        # the output object of a row; input values and fields that are None are left out
+        output_row={}
+        for i in range(0,len(self.col_names)):
+            if self.columns[i][index] is not None:
+                output_row[self.col_names[i]]=self.columns[i][index]
+        output_row.update(self.constants)
+        for name, field in self.fields.items():
+            if field[index] is not None:
+                output_row[name]=field[index]
+        if self.responses[index] is not None:
+            output_row['response']=self.responses[index]
+        return output_row
+
+    def to_json(self, debug=None):
+        # serialize into the Snowflake result format; the debug object is added to the first row
+        parts=[]
+        for index in range(0,len(self.row_numbers)):
+            output_row=self.output_row(index)
+            if index == 0 and debug is not None:
+                output_row['debug']=debug
+            parts.append(json.dumps([self.row_numbers[index], [output_row]]))
+        return '{"data": ['+', '.join(parts)+']}'
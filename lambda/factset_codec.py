@@ -0,0 +1,67 @@
+import os
+import gzip
+import base64
+
+# Encoding of request and response bodies at the external function boundary.
+# Snowflake sends gzip compressed request bodies and accepts compressed responses
+# when the external function is created with COMPRESSION = GZIP (or AUTO); API
+# Gateway hands binary bodies to the lambda base64 encoded with isBase64Encoded set.
+
+# responses smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES=int(os.environ.get('FACTSET_MIN_COMPRESS_BYTES','1024'))
+COMPRESS_LEVEL=int(os.environ.get('FACTSET_COMPRESS_LEVEL','5'))
+
+
+def event_headers(event):
+    # header names are case insensitive
+    return {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+
+
+def accepts_encoding(accept_encoding, coding):
+    # whether an Accept-Encoding header value like "gzip;q=0.5, *;q=0" allows the
+    # coding; a q-value of 0 rules it out and * stands for codings not listed
+    qvalues={}
+    for token in accept_encoding.split(','):
+        parts=[part.strip() for part in token.split(';')]
+        if parts[0] == '':
+            continue
+        qvalue=1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue=float(value)
+                except ValueError:
+                    qvalue=0.0
+        qvalues[parts[0].lower()]=qvalue
+
+    qvalue=qvalues.get(coding, qvalues.get('*', 0.0))
+    return qvalue > 0
+
+
+def decode_body(event):
+    # return the request body of an API Gateway event as text
+    body=event['body']
+    if event.get('isBase64Encoded'):
+        body=base64.b64decode(body)
+
+    if isinstance(body, bytes):
+        if 'gzip' in event_headers(event).get('content-encoding',''):
+            body=gzip.decompress(body)
+        body=body.decode('utf-8')
+    return body
+
+
+def encode_response(event, status_code, body):
+    # build the lambda response; the body is gzip compressed if the caller accepts it
+    response={
+        'statusCode': status_code,
+        'body': body
+    }
+
+    if accepts_encoding(event_headers(event).get('accept-encoding',''), 'gzip') and len(body) >= MIN_COMPRESS_BYTES:
+        response['body']=base64.b64encode(gzip.compress(body.encode('utf-8'), compresslevel=COMPRESS_LEVEL)).decode('ascii')
+        response['isBase64Encoded']=True
+        response['headers']={'Content-Encoding': 'gzip'}
+
+    return response
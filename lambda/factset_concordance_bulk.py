@@ -0,0 +1,286 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+
+from factset_api import get_secret, get_session, api_url
+from factset_concordance_task_post import build_task_request, MAX_BATCH_ROWS, TASK_URL_PATH
+from factset_concordance_task_decision_get import DECISIONS_URL_PATH, TASK_STATUS_FINISHED, TASK_STATUS_FAILED, get_task_status
+
+# Offline concordance of a large company list without Snowflake. The input (csv or
+# parquet) is streamed in chunks; every chunk is uploaded as one entity task and
+# the decisions of all open tasks are polled concurrently. Results are appended to
+# the output csv as soon as a task is decided.
+#
+#    python factset_concordance_bulk.py companies.csv concorded.csv
+#
+# The checkpoint file records the taskId of every submitted chunk, the completed
+# chunks and the size of the output file after the last completed chunk. A crashed
+# run is resumed with the same command; submitted chunks are polled again instead
+# of being uploaded a second time.
+#
+# A task that fails or isn't decided within --max-wait seconds marks its chunk as
+# FAILED in the checkpoint, none of its rows are written and the run goes on.
+# Failed chunks are skipped on resume unless --retry-failed is given. Progress is
+# reported on stderr.
+
+FACTSET_API_READ_TIMEOUT=25
+
+STATUS_SUBMITTED='SUBMITTED'
+STATUS_COMPLETED='COMPLETED'
+STATUS_REVIEW='REVIEW'
+# chunk status only; rows of failed chunks aren't written
+STATUS_FAILED='FAILED'
+MAP_STATUS_MAPPED='MAPPED'
+
+input_names=['name','country','state','url']
+output_names=['row_number','name','country','state','url','task_id','task_index','status','map_status','entity_id']
+
+
+def read_chunks(path, columns, chunk_size):
+    # yield (offset, rows) with rows as [row_number, name, country, state, url];
+    # only one chunk of the input is held in memory at a time
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('reading parquet files requires pyarrow; pip install pyarrow')
+
+        offset=0
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            records=batch.to_pylist()
+            yield offset, [[offset+i]+[record[column] for column in columns] for i, record in enumerate(records)]
+            offset+=len(records)
+    else:
+        with open(path, newline='', encoding='utf-8') as file:
+            reader=csv.DictReader(file)
+            offset=0
+            rows=[]
+            for record in reader:
+                rows.append([offset+len(rows)]+[(record.get(column) or None) for column in columns])
+                if len(rows) == chunk_size:
+                    yield offset, rows
+                    offset+=len(rows)
+                    rows=[]
+            if rows:
+                yield offset, rows
+
+
+class Checkpoint:
+    # chunk offsets are stored as strings since they are json object keys
+
+    def __init__(self, path, input_path, chunk_size):
+        self.path=path
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                self.state=json.load(file)
+            if self.state['input'] != input_path or self.state['chunk_size'] != chunk_size:
+                raise SystemExit('checkpoint '+path+' was written for '+self.state['input']
+                    +' with chunk size '+str(self.state['chunk_size']))
+        else:
+            self.state={'input': input_path, 'chunk_size': chunk_size, 'output_size': 0, 'chunks': {}}
+
+    def chunk(self, offset):
+        return self.state['chunks'].get(str(offset))
+
+    def submitted(self, offset, end, task_id):
+        self.state['chunks'][str(offset)]={'end': end, 'taskId': task_id, 'status': STATUS_SUBMITTED, 'submitted': time.time()}
+        self.save()
+
+    def completed(self, offset, output_size, status=STATUS_COMPLETED, reason=None):
+        self.state['chunks'][str(offset)]['status']=status
+        if reason is not None:
+            self.state['chunks'][str(offset)]['reason']=reason
+        self.state['output_size']=output_size
+        self.save()
+
+    def save(self):
+        # write a new file and replace the old one, a crash never leaves a partial checkpoint
+        temp_path=self.path+'.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+
+class BulkConcordance:
+
+    def __init__(self, session, output, checkpoint, max_inflight, poll_interval, max_wait, retry_failed):
+        self.session=session
+        self.output=output
+        self.writer=csv.writer(output)
+        self.checkpoint=checkpoint
+        self.max_inflight=max_inflight
+        self.poll_interval=poll_interval
+        self.max_wait=max_wait
+        self.retry_failed=retry_failed
+        self.executor=ThreadPoolExecutor(max_workers=max_inflight)
+        # offset -> (task_id, batch of output rows, submit time) of all tasks not decided yet
+        self.inflight={}
+        self.rows_written=0
+        self.chunks_failed=0
+
+    def submit(self, offset, rows):
+        chunk=self.checkpoint.chunk(offset)
+        if chunk is not None and chunk['status'] == STATUS_COMPLETED:
+            return
+        if chunk is not None and chunk['status'] == STATUS_FAILED:
+            if not self.retry_failed:
+                self.chunks_failed+=1
+                return
+            chunk=None
+
+        payload, file_content, batch = build_task_request(rows)
+        if chunk is None:
+            files={}
+            files['inputFile']=file_content.encode('utf-8')
+            response=self.session.post(api_url(TASK_URL_PATH), files=files, data=payload, timeout=FACTSET_API_READ_TIMEOUT)
+            response.raise_for_status()
+            task_id=str((response.json())['data']['taskId'])
+            self.checkpoint.submitted(offset, offset+len(rows), task_id)
+            submitted=time.time()
+            log('submitted rows '+str(offset)+'-'+str(offset+len(rows)-1)+' as task '+task_id)
+        else:
+            task_id=chunk['taskId']
+            submitted=chunk.get('submitted', time.time())
+
+        self.inflight[offset]=(task_id, batch, submitted)
+
+    def get_decisions(self, task_id, row_count):
+        # download all decisions of a task; None while the task isn't fully decided
+        decisions=[]
+        params={'taskId': task_id, 'offset': 0, 'limit': MAX_BATCH_ROWS}
+        while len(decisions) < row_count:
+            params['offset']=len(decisions)
+            response=self.session.get(api_url(DECISIONS_URL_PATH), params=params, timeout=FACTSET_API_READ_TIMEOUT)
+            response.raise_for_status()
+            page=(response.json())['data']
+            if len(page) == 0:
+                break
+            decisions.extend(page)
+
+        if len(decisions) < row_count or not all(('mapStatus' in decision) for decision in decisions):
+            return None
+        return decisions
+
+    def check(self, task_id, row_count):
+        # returns the decisions of a decided task, the reason a task failed or
+        # None for both while it's still processing; a failed request counts as
+        # still processing, so only --max-wait fails a task that can't be read
+        task_status, response_time_ms = get_task_status(self.session, task_id, {'Accept': 'application/json'}, FACTSET_API_READ_TIMEOUT)
+        if task_status is not None:
+            if task_status.get('status') in TASK_STATUS_FAILED:
+                return None, 'task ended with status '+str(task_status.get('status'))
+            if task_status.get('status') not in TASK_STATUS_FINISHED:
+                return None, None
+        # the task is finished or its status is unknown
+        try:
+            return self.get_decisions(task_id, row_count), None
+        except (RequestException, ValueError, KeyError) as err:
+            log('reading the decisions of task '+task_id+' failed: '+str(err))
+            return None, None
+
+    def poll(self):
+        # poll all open tasks concurrently and write the results of decided and
+        # failed tasks; returns the number of tasks done
+        offsets=list(self.inflight.keys())
+        results=self.executor.map(lambda offset: self.check(self.inflight[offset][0], len(self.inflight[offset][1])), offsets)
+
+        done=0
+        for offset, (decisions, reason) in zip(offsets, results):
+            task_id, batch, submitted = self.inflight[offset]
+            if decisions is None and reason is None and time.time()-submitted > self.max_wait:
+                reason='task not decided after %g seconds' % self.max_wait
+            if decisions is None and reason is None:
+                continue
+
+            del self.inflight[offset]
+            if decisions is not None:
+                for task_index in range(0,len(batch)):
+                    decision=decisions[task_index]
+                    status=STATUS_COMPLETED if decision.get('mapStatus') == MAP_STATUS_MAPPED else STATUS_REVIEW
+                    self.writer.writerow([batch.row_numbers[task_index]]+batch.values(task_index)
+                        +[task_id, task_index, status, decision.get('mapStatus'), decision.get('entityId')])
+                self.output.flush()
+                os.fsync(self.output.fileno())
+                self.rows_written+=len(batch)
+
+            if decisions is None:
+                self.checkpoint.completed(offset, self.output.tell(), STATUS_FAILED, reason)
+                self.chunks_failed+=1
+                log('task '+task_id+' (rows '+str(offset)+'-'+str(offset+len(batch)-1)+') failed: '+reason)
+            else:
+                self.checkpoint.completed(offset, self.output.tell())
+                log('task '+task_id+' (rows '+str(offset)+'-'+str(offset+len(batch)-1)+') decided')
+            done+=1
+        return done
+
+    def wait(self, max_open):
+        # poll until at most max_open tasks are still open
+        while len(self.inflight) > max_open:
+            if self.poll() == 0:
+                log(str(len(self.inflight))+' tasks open, '+str(self.rows_written)+' rows written, '
+                    +str(self.chunks_failed)+' chunks failed')
+                time.sleep(self.poll_interval)
+
+
+def log(message):
+    print(time.strftime('%H:%M:%S')+' '+message, file=sys.stderr, flush=True)
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Concord a company list with the FactSet entity task API')
+    parser.add_argument('input', help='csv or parquet file with columns name, country, state, url')
+    parser.add_argument('output', help='csv file the results are appended to')
+    parser.add_argument('--checkpoint', help='checkpoint file (default: <output>.checkpoint)')
+    parser.add_argument('--columns', default=','.join(input_names),
+        help='input columns holding name, country, state and url (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=MAX_BATCH_ROWS,
+        help='rows per entity task, at most '+str(MAX_BATCH_ROWS)+' (default: %(default)s)')
+    parser.add_argument('--max-inflight', type=int, default=8, help='tasks polled concurrently (default: %(default)s)')
+    parser.add_argument('--poll-interval', type=float, default=30, help='seconds between polls (default: %(default)s)')
+    parser.add_argument('--max-wait', type=float, default=24*3600,
+        help='seconds after which an undecided task is marked as failed (default: %(default)s)')
+    parser.add_argument('--retry-failed', action='store_true', help='submit the chunks of failed tasks again')
+    args=parser.parse_args()
+
+    columns=args.columns.split(',')
+    if len(columns) != len(input_names):
+        parser.error('--columns needs '+str(len(input_names))+' column names')
+    chunk_size=max(1,min(args.chunk_size, MAX_BATCH_ROWS))
+
+    checkpoint=Checkpoint(args.checkpoint or args.output+'.checkpoint', os.path.abspath(args.input), chunk_size)
+
+    # drop everything written after the last completed chunk of a crashed run
+    mode='r+' if os.path.exists(args.output) else 'w'
+    output=open(args.output, mode, newline='', encoding='utf-8')
+    output.truncate(checkpoint.state['output_size'])
+    output.seek(checkpoint.state['output_size'])
+    if checkpoint.state['output_size'] == 0:
+        csv.writer(output).writerow(output_names)
+        output.flush()
+        checkpoint.state['output_size']=output.tell()
+        checkpoint.save()
+
+    session=get_session(json.loads(get_secret()))
+    bulk=BulkConcordance(session, output, checkpoint, max(1,args.max_inflight), args.poll_interval, args.max_wait, args.retry_failed)
+    try:
+        for offset, rows in read_chunks(args.input, columns, chunk_size):
+            bulk.wait(bulk.max_inflight-1)
+            bulk.submit(offset, rows)
+        bulk.wait(0)
+        log('done, '+str(bulk.rows_written)+' rows written, '+str(bulk.chunks_failed)+' chunks failed')
+    finally:
+        bulk.executor.shutdown()
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
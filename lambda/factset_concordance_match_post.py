@@ -1,80 +1,138 @@
+import os
 import json
 import time
 
-import boto3
-import base64
-
 import requests
 from requests.exceptions import Timeout
 
-def get_secret():
+from factset_api import get_secret, get_session, api_url, TTLCache
+from factset_codec import decode_body, encode_response
+from factset_batch import Batch
 
-    secret_name = "FactsetAPICredentials"
-    region_name = "us-west-1"
+# largest number of rows matched in one entity-match request
+MAX_BATCH_ROWS=25
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+# matches per requested tuple; shared by all invocations of this process
+MATCH_RESULT_CACHE=TTLCache(int(os.environ.get('FACTSET_MATCH_CACHE_TTL','3600')))
 
-    # In this sample we only handle the specific exceptions for the 'GetSecretValue' API.
-    # See https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-    # We rethrow the exception by default.
+def match_rows(rows, timeout=None):
+    # match the rows [row_number, name, country, state, url]; returns the status code
+    # and either the batch of output rows and the debug object or an error message.
+    # The timeout in seconds defaults to FACTSET_API_READ_TIMEOUT
+ 
+    FACTSET_API_READ_TIMEOUT=25
+    
+    col_names=['name','country','state','url']
 
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            # Secrets Manager can't decrypt the protected secret text using the provided KMS key.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            # An error occurred on the server side.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            # You provided an invalid value for a parameter.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            # You provided a parameter value that is not valid for the current state of the resource.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # We can't find the resource that you asked for.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
+    row_count=len(rows)
+
+    # Get Credentials from Secret Manager
+    ssm_begin_ts=time.time()
+    secret = json.loads(get_secret());
+    ssm_end_ts=time.time()
+    
+    ssm_response_time_ms=int(((ssm_end_ts-ssm_begin_ts)*1000)/row_count)
+    
+    # initialize request  object
+    headers={'Content-type': 'application/json;charset=UTF-8', 'Accept': 'application/json'}
+    url=api_url('/content/factset-concordance/v1/entity-match')
+
+    session=get_session(secret)
+    timeout=(timeout or FACTSET_API_READ_TIMEOUT)
+    
+    # initialize the parameter object send to the API. It's a dictionary with an array named input 
+    # holding dictionaries with the company match information
+    data={}
+    data['input']=[]
+
+    # the output rows are kept in a columnar batch and only serialized at the end
+    batch=Batch.from_rows(rows, col_names)
+
+    # tuple already matched by an earlier invocation are answered from the cache;
+    # api_rows holds the output row for each entry in data['input']
+    api_rows=[]
+    api_keys=[]
+
+    # For each input row in the JSON object...
+
+    for output_index in range(0,len(batch)):
+
+        # Read all not null values and add them to the filter
+
+        request = {}
+        
+        values=batch.values(output_index)
+        for i in range(0,len(col_names)):
+            if not (values[i] == None):
+                request[col_names[i]]=values[i]
+
+        cache_key=json.dumps(request, sort_keys=True)
+        cached=MATCH_RESULT_CACHE.get(cache_key)
+        if cached is None:
+            # append the request to the existing input array            
+            data['input'].append(request)
+            api_rows.append(output_index)
+            api_keys.append(cache_key)
+        elif len(cached) > 0:
+            batch.responses[output_index]=[dict(match, rowIndex=output_index) for match in cached]
+        
+    try: 
+
+        api_response_time_ms=0
+        api_response=[]
+        if len(data['input']) > 0:
+            api_begin_ts=time.time()
+            response=session.post(url,data=json.dumps(data),headers=headers,timeout=timeout)
+            api_end_ts=time.time()
             
-    return secret 
+            response.raise_for_status()
+
+            api_response_time_ms=int((api_end_ts-api_begin_ts)*1000)
+            api_response=(response.json())['data']
+
+        billing_response_time_ms = api_response_time_ms+ssm_response_time_ms
+
+        debug={}
+        debug['api_response_time_ms']=api_response_time_ms
+        debug['billing_response_time_ms']=billing_response_time_ms
+        debug['api_response']=api_response
+        debug['api_status']=200
+        debug['api_rows']=len(api_rows)
+        
+        # match all responses by rowIndex to the output rows and add each response dictionary 
+        # to the response of the output row. Note that there are multiple objects
+        # returned by the API for each company match request. They are sorted by confidence score
+        for row in api_response:
+            # translate the rowIndex of the api request into the output row number
+            row_number = api_rows[int(row['rowIndex'])]
+            row['rowIndex']=row_number
+            if batch.responses[row_number] is not None:
+                batch.responses[row_number].append(row)
+            else:
+                batch.responses[row_number]=[row]
+
+        # cache the matches of all requested tuple, including tuple without any match
+        for i in range(0,len(api_rows)):
+            MATCH_RESULT_CACHE.put(api_keys[i], batch.responses[api_rows[i]] or [])
+
+        return 200, batch, debug
+        
+    except Timeout as err:
+        return 408, "HTTP Timeout: "+ url + " exceeded "+str(timeout)+" seconds", None
+        
+    except Exception as err:
+        return response.status_code, "Error calling "+ url + ": " + response.text, None
+
 
 def lambda_handler(event, context):
- 
-    MAX_BATCH_ROWS=25
-    FACTSET_API_READ_TIMEOUT=25
     
     # 200 is the HTTP status code for "ok".
     status_code = 200
-    
-    # The return value will contain an array of arrays (one inner array per input row).
-    array_of_rows_to_return = [ ]
-    
-    col_names=['name','country','state','url']
  
     try:
         # From the input parameter named "event", get the body, which contains
         # the input rows.
-        event_body = event["body"]
+        event_body = decode_body(event)
  
         # Convert the input from a JSON string into a JSON object.
         payload = json.loads(event_body)
@@ -82,89 +140,15 @@ def lambda_handler(event, context):
         # row number, and a value for each parameter passed to the function.
         
         rows = payload["data"]
-        row_count=len(rows)
         if (len(rows) > MAX_BATCH_ROWS):
             status_code = 400;
             json_compatible_string_to_return="Too many rows in batch; Set MAX_BATCH_ROWS="+str(MAX_BATCH_ROWS) 
         else:
-        
-            # Get Credentials from Secret Manager
-            ssm_begin_ts=time.time()
-            secret = json.loads(get_secret());
-            ssm_end_ts=time.time()
-            
-            ssm_response_time_ms=int(((ssm_end_ts-ssm_begin_ts)*1000)/row_count)
-            
-            # initialize request  object
-            headers={'Content-type': 'application/json;charset=UTF-8', 'Accept': 'application/json'}
-            url='https://api.factset.com/content/factset-concordance/v1/entity-match'
-
-            session=requests.Session()
-            session.auth=(secret['APIUser'],secret['APIKey'])
-            timeout=(FACTSET_API_READ_TIMEOUT)
-            
-            # initialize the parameter object send to the API. It's a dictionary with an array named input 
-            # holding dictionaries with the company match information
-            data={}
-            data['input']=[]
-    
-            # For each input row in the JSON object...
-
-            for row in rows:
-                # Read the input row number (the output row number will be the same).
-                row_number = row[0]
-     
-                # Read all not null values and add them to the filter
-
-                request = {}
-                
-                for i in range(1,len(row)):
-                    if not (row[i] == None):
-                        request[col_names[i-1]]=row[i]
-                
-                # append the request to the existing input array            
-                data['input'].append(request)
-                
-                # also copy the company match information into an output object
-                array_of_rows_to_return.append([row_number,[request]])
-                
-            try: 
-
-                api_begin_ts=time.time()
-                response=session.post(url,data=json.dumps(data),headers=headers,timeout=timeout)
-                api_end_ts=time.time()
-                
-                response.raise_for_status()
-    
-                api_response_time_ms=int((api_end_ts-api_begin_ts)*1000)
-                billing_response_time_ms = api_response_time_ms+ssm_response_time_ms
-    
-                array_of_rows_to_return[0][1][0]['debug']={}
-                array_of_rows_to_return[0][1][0]['debug']['api_response_time_ms']=api_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['billing_response_time_ms']=billing_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['api_response']=(response.json())['data']
-                array_of_rows_to_return[0][1][0]['debug']['api_status']=200
-                
-                # match all responses by rowIndex to the output objects and add each response dictionary 
-                # to a corresponding object in the output object. Note that there are multiple objects
-                # returned by the API for each company match request. They are sorted by confidence score
-                for row in (response.json())['data']:
-                    # Read the input row number (the output row number will be the same).
-                    row_number = int(row['rowIndex'])
-                    if 'response' in array_of_rows_to_return[row_number][1][0]:
-                        (array_of_rows_to_return[row_number][1][0]['response']).append(row)
-                    else:
-                        array_of_rows_to_return[row_number][1][0]['response']=[row]
-    
-                json_compatible_string_to_return = json.dumps({"data" : array_of_rows_to_return})
-                
-            except Timeout as err:
-                status_code=408
-                json_compatible_string_to_return="HTTP Timeout: "+ url + " exceeded "+str(timeout)+" seconds"
-                
-            except Exception as err:
-                status_code=response.status_code
-                json_compatible_string_to_return="Error calling "+ url + ": " + response.text
+            status_code, result, debug = match_rows(rows)
+            if status_code == 200:
+                json_compatible_string_to_return = result.to_json(debug)
+            else:
+                json_compatible_string_to_return = result
             
     except Exception as err:
         # 400 implies some type of error.
@@ -173,7 +157,4 @@ def lambda_handler(event, context):
         json_compatible_string_to_return = str(err) #event_body
     
     # Return the return value and HTTP status code.
-    return {
-        'statusCode': status_code,
-        'body': json_compatible_string_to_return
-    }
\ No newline at end of file
+    return encode_response(event, status_code, json_compatible_string_to_return)
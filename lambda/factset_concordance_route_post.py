@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import math
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from factset_codec import decode_body, encode_response
+from factset_batch import Batch
+
+import factset_concordance_match_post
+import factset_concordance_task_post
+
+# Routes a batch of (name, country, state, url) rows either to the synchronous
+# entity-match API or to the asynchronous entity-task API. Small batches that can
+# be matched within the remaining time budget are matched right away in concurrent
+# sub-batches; everything else, including sub-batches whose match fails, is posted
+# as one entity task. Every output row has the input values plus
+#    route: MATCH   and mapStatus, entityId of the top candidate and response (match
+#                   candidates sorted by confidence score, rowIndex is the batch position)
+#    route: TASK    and taskId, taskStatus, rowIndex (position in the task)
+# so one external function serves interactive and bulk workloads; SP_ASYNC_BATCH
+# records MATCH rows as decided and polls TASK rows for decisions.
+
+ROUTE_MATCH="MATCH"
+ROUTE_TASK="TASK"
+
+MAP_STATUS_MAPPED="MAPPED"
+MAP_STATUS_UNMAPPED="UNMAPPED"
+
+# batches above this size always go to the task API
+MATCH_ROUTE_MAX_ROWS=int(os.environ.get('FACTSET_MATCH_ROUTE_MAX_ROWS','100'))
+# entity-match requests sent concurrently for one batch
+MATCH_CONCURRENCY=int(os.environ.get('FACTSET_MATCH_CONCURRENCY','4'))
+# time budget when the caller doesn't provide a lambda context
+DEFAULT_TIME_BUDGET_MS=int(os.environ.get('FACTSET_ROUTE_TIME_BUDGET_MS','25000'))
+# share of the remaining time the match path may use; the rest is kept for a task fallback
+MATCH_TIME_BUDGET_SHARE=0.5
+# latency recorded for a failed or timed out sub-batch, at least the time it took
+MATCH_FAILURE_PENALTY_MS=int(os.environ.get('FACTSET_MATCH_FAILURE_PENALTY_MS',str(DEFAULT_TIME_BUDGET_MS)))
+# without any match for this long the latency falls back to the initial value, so
+# the match path is tried again after it was avoided because of failures
+MATCH_LATENCY_RESET_S=int(os.environ.get('FACTSET_MATCH_LATENCY_RESET_S','300'))
+
+
+class LatencyTracker:
+    # exponentially weighted moving average of the latency of an endpoint; reset to
+    # the initial value if nothing was added for reset_s seconds
+
+    def __init__(self, initial_ms, weight=0.2, reset_s=MATCH_LATENCY_RESET_S):
+        self.initial_ms=initial_ms
+        self.latency_ms=initial_ms
+        self.weight=weight
+        self.reset_s=reset_s
+        self.updated=time.time()
+        self.lock=threading.Lock()
+
+    def add(self, latency_ms):
+        with self.lock:
+            self.latency_ms=(1-self.weight)*self.latency_ms+self.weight*latency_ms
+            self.updated=time.time()
+
+    def get(self):
+        with self.lock:
+            if time.time()-self.updated > self.reset_s:
+                self.latency_ms=self.initial_ms
+                self.updated=time.time()
+            return self.latency_ms
+
+
+# latency of one entity-match sub-batch; shared by all invocations of this process
+MATCH_LATENCY=LatencyTracker(int(os.environ.get('FACTSET_MATCH_LATENCY_MS','3000')))
+
+
+def remaining_time_ms(context):
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return context.get_remaining_time_in_millis()
+    return DEFAULT_TIME_BUDGET_MS
+
+
+def match_sub_batch(rows, timeout):
+    # returns the batch of output rows or None if the match failed; failures count
+    # with at least MATCH_FAILURE_PENALTY_MS so a degraded API is routed around
+    begin_ts=time.time()
+    try:
+        status_code, result, debug = factset_concordance_match_post.match_rows(rows, timeout)
+    except Exception as err:
+        status_code=None
+
+    if status_code != 200:
+        MATCH_LATENCY.add(max((time.time()-begin_ts)*1000, MATCH_FAILURE_PENALTY_MS))
+        return None
+
+    # sub-batches answered from the match cache say nothing about the API latency
+    if debug['api_rows'] > 0:
+        MATCH_LATENCY.add((time.time()-begin_ts)*1000)
+    return result
+
+
+def lambda_handler(event, context):
+
+    begin_ts=time.time()
+
+    # 200 is the HTTP status code for "ok".
+    status_code = 200
+
+    try:
+        # From the input parameter named "event", get the body, which contains
+        # the input rows.
+        event_body = decode_body(event)
+
+        # Convert the input from a JSON string into a JSON object.
+        payload = json.loads(event_body)
+        rows = payload["data"]
+        row_count=len(rows)
+
+        if (row_count > factset_concordance_task_post.MAX_BATCH_ROWS):
+            status_code = 400
+            json_compatible_string_to_return="Too many rows in batch; Set MAX_BATCH_ROWS="+str(factset_concordance_task_post.MAX_BATCH_ROWS)
+        else:
+            # the output rows are kept in a columnar batch and only serialized at the end
+            batch=Batch.from_rows(rows, ['name','country','state','url'])
+
+            # positions of the rows that are posted as a task
+            task_positions=range(0,row_count)
+
+            sub_batch_size=factset_concordance_match_post.MAX_BATCH_ROWS
+            sub_batch_offsets=range(0,row_count,sub_batch_size)
+
+            # estimated time to match all sub-batches with the available concurrency
+            match_latency_ms=MATCH_LATENCY.get()
+            match_estimate_ms=math.ceil(len(sub_batch_offsets)/MATCH_CONCURRENCY)*match_latency_ms
+            time_budget_ms=remaining_time_ms(context)*MATCH_TIME_BUDGET_SHARE
+
+            if row_count <= MATCH_ROUTE_MAX_ROWS and match_estimate_ms <= time_budget_ms:
+                task_positions=[]
+                # every wave of concurrent sub-batches has to finish within its share of
+                # the budget; a slower request times out and falls back to the task
+                match_timeout=time_budget_ms/math.ceil(len(sub_batch_offsets)/MATCH_CONCURRENCY)/1000
+                with ThreadPoolExecutor(max_workers=MATCH_CONCURRENCY) as executor:
+                    results=list(executor.map(lambda offset: match_sub_batch(rows[offset:offset+sub_batch_size], match_timeout), sub_batch_offsets))
+
+                for offset, result in zip(sub_batch_offsets, results):
+                    if result is None:
+                        task_positions.extend(range(offset,min(offset+sub_batch_size,row_count)))
+                        continue
+                    for i in range(0,len(result)):
+                        # candidates refer to the position in the routed batch, not in the sub-batch
+                        candidates=[dict(candidate, rowIndex=offset+i) for candidate in (result.responses[i] or [])]
+                        batch.set(offset+i,'route',ROUTE_MATCH)
+                        if len(candidates) > 0 and candidates[0].get('matchFlag'):
+                            batch.set(offset+i,'mapStatus',MAP_STATUS_MAPPED)
+                            batch.set(offset+i,'entityId',candidates[0].get('entityId'))
+                        else:
+                            batch.set(offset+i,'mapStatus',MAP_STATUS_UNMAPPED)
+                        batch.responses[offset+i]=candidates
+
+            if len(task_positions) > 0:
+                task_status_code, result, debug = factset_concordance_task_post.post_task([rows[position] for position in task_positions])
+                if task_status_code != 200:
+                    status_code=task_status_code
+                    json_compatible_string_to_return=result
+                else:
+                    for i in range(0,len(task_positions)):
+                        batch.set(task_positions[i],'route',ROUTE_TASK)
+                        for name, value in result.constants.items():
+                            batch.set(task_positions[i],name,value)
+                        for name, field in result.fields.items():
+                            batch.set(task_positions[i],name,field[i])
+
+            if status_code == 200:
+                debug={}
+                debug['route_time_ms']=int((time.time()-begin_ts)*1000)
+                debug['match_latency_ms']=int(match_latency_ms)
+                debug['match_estimate_ms']=int(match_estimate_ms)
+                debug['match_rows']=row_count-len(task_positions)
+                debug['task_rows']=len(task_positions)
+
+                json_compatible_string_to_return = batch.to_json(debug)
+
+    except Exception as err:
+        # 400 implies some type of error.
+        status_code = 400
+        # Tell caller what this function could not handle.
+        json_compatible_string_to_return = str(err)
+
+    # Return the return value and HTTP status code.
+    return encode_response(event, status_code, json_compatible_string_to_return)
@@ -1,66 +1,72 @@
+import os
 import json
 import time
 import re
 import io
 import uuid
 
-import boto3
-import base64
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from requests.exceptions import Timeout
+from requests.exceptions import Timeout, RequestException
 
+from factset_api import get_secret, get_session, api_url, TTLCache
+from factset_codec import decode_body, encode_response
+from factset_batch import Batch
 
-def get_secret():
+# decisions of tasks where every row has a mapStatus; a task is typically spread
+# over many batches, so all later batches of the same task are served from here
+DECISION_RESULT_CACHE=TTLCache(int(os.environ.get('FACTSET_DECISION_CACHE_TTL','600')))
 
-    secret_name = "FactsetAPICredentials"
-    region_name = "us-west-1"
+DECISIONS_URL_PATH='/content/factset-concordance/v1/entity-decisions'
+TASK_STATUS_URL_PATH='/content/factset-concordance/v1/entity-task-status'
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+# task states after which all decisions can be downloaded
+TASK_STATUS_FINISHED=('SUCCESS','COMPLETED')
+# task states of tasks that will never be decided
+TASK_STATUS_FAILED=('FAILURE','FAILED','ERROR','CANCELLED')
+# task status requests sent concurrently for one batch
+TASK_STATUS_CONCURRENCY=int(os.environ.get('FACTSET_TASK_STATUS_CONCURRENCY','8'))
 
-    # In this sample we only handle the specific exceptions for the 'GetSecretValue' API.
-    # See https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-    # We rethrow the exception by default.
 
+def get_task_status(session, task_id, headers, timeout):
+    # returns the status object of a task and the response time; the status is None
+    # if it can't be retrieved, the decisions of the task are downloaded in that case
+    api_begin_ts=time.time()
+    task_status=None
     try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            # Secrets Manager can't decrypt the protected secret text using the provided KMS key.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            # An error occurred on the server side.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            # You provided an invalid value for a parameter.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            # You provided a parameter value that is not valid for the current state of the resource.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # We can't find the resource that you asked for.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-            
-    return secret 
+        response=session.get(api_url(TASK_STATUS_URL_PATH), params={'taskId': task_id}, headers=headers, timeout=timeout)
+        if response.status_code == 200:
+            data=(response.json()).get('data')
+            task_status=data[0] if isinstance(data, list) and len(data) > 0 else data
+            if not isinstance(task_status, dict):
+                task_status=None
+    except (RequestException, ValueError) as err:
+        task_status=None
+    api_end_ts=time.time()
+
+    return task_status, int((api_end_ts-api_begin_ts)*1000)
+
+
+def pending_response(task_status):
+    # the response of a row of an unfinished task; it has no mapStatus, so the row
+    # stays PENDING, and reports how far the task has got
+    response={}
+    response['taskStatus']=task_status.get('status')
+    if 'progress' in task_status:
+        response['progress']=task_status['progress']
+    elif task_status.get('inputRecordCount'):
+        response['progress']=round(100*(task_status.get('processedRecordCount') or 0)/task_status['inputRecordCount'])
+    return response
+
+
+def failed_response(task_status):
+    # the response of a row of a task that ended without decisions
+    response={}
+    response['taskStatus']=task_status.get('status')
+    response['error']="Task ended with status "+str(task_status.get('status'))
+    return response
+
 
 def lambda_handler(event, context):
  
@@ -69,9 +75,6 @@ def lambda_handler(event, context):
     
     # 200 is the HTTP status code for "ok".
     status_code = 200
-    
-    # The return value will contain an array of arrays (one inner array per input row).
-    array_of_rows_to_return = [ ]
 
     # map input values with column names    
     col_names=['name','country','state','url','taskId','rowIndex']
@@ -79,7 +82,7 @@ def lambda_handler(event, context):
     try:
         # From the input parameter named "event", get the body, which contains
         # the input rows.
-        event_body = event["body"]
+        event_body = decode_body(event)
  
         # Convert the input from a JSON string into a JSON object.
         payload = json.loads(event_body)
@@ -102,29 +105,17 @@ def lambda_handler(event, context):
             
             # initialize request  object
             headers={'Content-type': 'application/json;charaset=UTF-8', 'Accept': 'application/json'}
-            url='https://api.factset.com/content/factset-concordance/v1/entity-decisions'
+            url=api_url(DECISIONS_URL_PATH)
             
-            session=requests.Session()
-            session.auth=(secret['APIUser'],secret['APIKey'])
+            session=get_session(secret)
             timeout=(FACTSET_API_READ_TIMEOUT)
     
-            # For each input row in the JSON object...
-            task_set=set()
-            debug=0
-            for row in rows:
-                # find unique taskIds
-                task_set.add(row[5])
-                
-                # prepare output object
-                row_number=row[0]
-                output_row = {}
-                
-                # map input values to output 
-                for i in range(1,len(row)):
-                    if not (row[i] == None):
-                        output_row[col_names[i-1]]=row[i]
-    
-                array_of_rows_to_return.append([row_number,[output_row]])
+            # the output rows are kept in a columnar batch and only serialized at the end
+            batch=Batch.from_rows(rows, col_names)
+
+            # find unique taskIds
+            task_ids=batch.columns[col_names.index('taskId')]
+            task_set=set(task_ids)
                 
             # initialize a results dictionary since we first request updates
             # for all task and then map the results to output rows
@@ -137,6 +128,23 @@ def lambda_handler(event, context):
             try:
                 api_response_time_ms=0
 
+                # check the status of all tasks not decided yet; decisions are only
+                # downloaded for finished tasks
+                unknown_tasks=[taskId for taskId in task_set if DECISION_RESULT_CACHE.get(taskId) is None]
+                pending_tasks={}
+                failed_tasks={}
+                if len(unknown_tasks) > 0:
+                    with ThreadPoolExecutor(max_workers=TASK_STATUS_CONCURRENCY) as executor:
+                        statuses=list(executor.map(lambda taskId: get_task_status(session, taskId, headers, timeout), unknown_tasks))
+                    for taskId, (task_status, status_response_time_ms) in zip(unknown_tasks, statuses):
+                        api_response_time_ms+=status_response_time_ms
+                        if task_status is None or task_status.get('status') in TASK_STATUS_FINISHED:
+                            continue
+                        if task_status.get('status') in TASK_STATUS_FAILED:
+                            failed_tasks[taskId]=task_status
+                        else:
+                            pending_tasks[taskId]=task_status
+
                 for taskId in task_set:
                     try:
                         params['taskId']=taskId
@@ -144,6 +152,28 @@ def lambda_handler(event, context):
                         # initialize results dictionary for selected task
                         
                         result_dict[taskId]={}
+
+                        cached=DECISION_RESULT_CACHE.get(taskId)
+                        if cached is not None:
+                            result_dict[taskId]['task_api_response_time_ms']=0
+                            result_dict[taskId]['status_code']=200
+                            result_dict[taskId]['response']=cached
+                            continue
+
+                        task_status=pending_tasks.get(taskId)
+                        if task_status is not None:
+                            result_dict[taskId]['task_api_response_time_ms']=0
+                            result_dict[taskId]['status_code']=200
+                            result_dict[taskId]['status_response']=pending_response(task_status)
+                            continue
+
+                        task_status=failed_tasks.get(taskId)
+                        if task_status is not None:
+                            result_dict[taskId]['task_api_response_time_ms']=0
+                            result_dict[taskId]['status_code']=200
+                            result_dict[taskId]['status_response']=failed_response(task_status)
+                            continue
+
                         api_begin_ts=time.time()
                         response=session.get(url,params=params, headers=headers, timeout=timeout)
                         api_end_ts=time.time()
@@ -157,6 +187,10 @@ def lambda_handler(event, context):
                         result_dict[taskId]['task_api_response_time_ms']=task_api_response_time_ms
                         result_dict[taskId]['status_code'] = response.status_code
                         result_dict[taskId]['response'] = (response.json())['data']
+
+                        decisions=result_dict[taskId]['response']
+                        if len(decisions) > 0 and all(('mapStatus' in decision) for decision in decisions):
+                            DECISION_RESULT_CACHE.put(taskId, result_dict[taskId]['response'])
                         
                     except Timeout as err:
                         raise
@@ -169,29 +203,34 @@ def lambda_handler(event, context):
 
                 # collect debug information. By default the results_dict is NOT returned
                 # since it could exceed the 6 mb lambda output constraint
-                array_of_rows_to_return[0][1][0]['debug']={}
-                array_of_rows_to_return[0][1][0]['debug']['api_response_time_ms']=api_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['billing_response_time_ms']=billing_response_time_ms
-                #array_of_rows_to_return[0][1][0]['debug']['results']=result_dict
+                debug={}
+                debug['api_response_time_ms']=api_response_time_ms
+                debug['billing_response_time_ms']=billing_response_time_ms
+                debug['pending_tasks']=len(pending_tasks)
+                debug['failed_tasks']=len(failed_tasks)
+                #debug['results']=result_dict
 
                 # for all output row
-                for row in array_of_rows_to_return:
+                row_indexes=batch.columns[col_names.index('rowIndex')]
+                for output_index in range(0,len(batch)):
                     
-                    output_row=row[1][0]
+                    result=result_dict[task_ids[output_index]]
                     
                     # if the response for the task of the output row is 200
                     # then find the response object based on input parameter rowIndex 
                     # and store it with the output row
-                    if result_dict[output_row['taskId']]['status_code']==200:
-                        response=result_dict[output_row['taskId']]['response']
-                        if  int(output_row['rowIndex']) < len(response) :
-                            output_row['response']=[response[int(output_row['rowIndex'])]]
+                    if 'status_response' in result:
+                        batch.responses[output_index]=[result['status_response']]
+                    elif result['status_code']==200:
+                        response=result['response']
+                        if  int(row_indexes[output_index]) < len(response) :
+                            batch.responses[output_index]=[response[int(row_indexes[output_index])]]
                         else:
-                            output_row['response']=['API Row Index not found']                            
+                            batch.responses[output_index]=['API Row Index not found']
                     else:
-                        output_row['response']=[result_dict[output_row['taskId']]['response']]
+                        batch.responses[output_index]=[result['response']]
 
-                json_compatible_string_to_return = json.dumps({"data" : array_of_rows_to_return})
+                json_compatible_string_to_return = batch.to_json(debug)
 
             except Timeout as err:
                 status_code=408
@@ -204,7 +243,4 @@ def lambda_handler(event, context):
         json_compatible_string_to_return = str(err) # event_body
     
     # Return the return value and HTTP status code.
-    return {
-        'statusCode': status_code,
-        'body': json_compatible_string_to_return,
-    }
\ No newline at end of file
+    return encode_response(event, status_code, json_compatible_string_to_return)
\ No newline at end of file
@@ -1,87 +1,185 @@
+import os
 import json
 import time
 import re
 import io
-import uuid
+import hashlib
+import threading
 
-import boto3
-import base64
+from contextlib import contextmanager
 
 import requests
 from requests.exceptions import Timeout
 
+from factset_api import get_secret, get_session, api_url, PersistentTTLCache
+from factset_codec import decode_body, encode_response
+from factset_batch import Batch
 
-def get_secret():
+# largest number of rows uploaded in one entity task
+MAX_BATCH_ROWS=1000
+TASK_URL_PATH='/content/factset-concordance/v1/entity-task'
 
-    secret_name = "FactsetAPICredentials"
-    region_name = "us-west-1"
+# task created for each task name; Snowflake retries a batch after a timeout or an
+# error and the retry has to get the original task instead of creating a new one
+TASK_IDEMPOTENCY_CACHE=PersistentTTLCache('tasks', int(os.environ.get('FACTSET_TASK_IDEMPOTENCY_TTL','3600')))
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+# task name -> [lock, number of requests holding or waiting for it]
+_task_locks={}
+_task_locks_lock=threading.Lock()
 
-    # In this sample we only handle the specific exceptions for the 'GetSecretValue' API.
-    # See https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-    # We rethrow the exception by default.
 
+@contextmanager
+def task_lock(task_name):
+    # serializes the lookup and the upload of one task name, so a retry arriving
+    # while the first attempt is still uploading waits for its task instead of
+    # creating a second one
+    with _task_locks_lock:
+        entry=_task_locks.setdefault(task_name, [threading.Lock(), 0])
+        entry[1]+=1
     try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            # Secrets Manager can't decrypt the protected secret text using the provided KMS key.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            # An error occurred on the server side.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            # You provided an invalid value for a parameter.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            # You provided a parameter value that is not valid for the current state of the resource.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # We can't find the resource that you asked for.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-            
-    return secret 
+        with entry[0]:
+            yield
+    finally:
+        with _task_locks_lock:
+            entry[1]-=1
+            if entry[1] == 0:
+                del _task_locks[task_name]
+
+
+def build_task_request(rows):
+    # create the form fields and the csv file for an entity-task upload from input
+    # rows [row_number, name, country, state, url]. Returns the form payload, the
+    # file content and the batch of output rows; the position of an output row
+    # is the rowIndex of the row within the task. The task name is a hash of the
+    # row values, i.e. the same rows always create the same task name
 
-def lambda_handler(event, context):
+    col_names=['name','country','state','url']
+    form_names=['nameColumn','countryColumn','stateColumn','urlColumn']
+
+    batch=Batch.from_rows(rows, col_names)
+
+    payload={}
+    task_hash=hashlib.sha256()
+
+    file=io.StringIO(initial_value='',newline='\n')
+
+    # create mapping between filter columns and column names            
+    file.write('row_number')
+    for i in range(0,len(form_names)):
+        file.write(',')
+        payload[form_names[i]]=col_names[i]
+        file.write(col_names[i])
+
+    # For each input row in the JSON object...
+    for index in range(0,len(batch)):
+        
+        # Read the input row number (the output row number will be the same).
+        file.write('\n')
+        file.write(str(batch.row_numbers[index]))
+
+        # write the values into the file object send to the API
+        values=batch.values(index)
+        task_hash.update(json.dumps(values).encode('utf-8'))
+        for value in values:
+            file.write(',')
+            if not (value == None):
+                # quotes within a value are escaped by doubling them
+                file.write('"'+str(value).replace('"','""')+'"')
+
+    # create a files object, unique identification for the uploaded file 
+    payload['taskName']='Snowflake_'+task_hash.hexdigest()[:32]
+
+    return payload, file.getvalue(), batch
+
+
+def post_task(rows):
+    # upload the rows [row_number, name, country, state, url] as one entity task;
+    # returns the status code and either the batch of output rows and the debug
+    # object or an error message
  
-    MAX_BATCH_ROWS=1000
     FACTSET_API_READ_TIMEOUT=25
 
-    begin_ts=time.time()
+    row_count=len(rows)
+
+    # Get Credentials from Secret Manager
+    ssm_begin_ts=time.time()
+    secret = json.loads(get_secret())
+    ssm_end_ts=time.time()
     
-    # 200 is the HTTP status code for "ok".
-    status_code = 200
+    ssm_response_time_ms=int(((ssm_end_ts-ssm_begin_ts)*1000)/row_count)
     
-    # The return value will contain an array of arrays (one inner array per input row).
-    array_of_rows_to_return = [ ]
+    # initialize request  object
+    #headers={'Content-Type': 'multipart/form-data;charset=UTF-8', 'Accept': 'application/json'}
+    url=api_url(TASK_URL_PATH)
+    session=get_session(secret)
+    timeout=(FACTSET_API_READ_TIMEOUT)
+    #session.headers.update={'Content-Type': 'multipart/form-data;charset=UTF-8', 'Accept': 'application/json'}
     
-    col_names=['name','country','state','url']
-    form_names=['nameColumn','countryColumn','stateColumn','urlColumn']
+    # create the form fields, the file uploaded to the API and the output rows
+    payload, file_content, batch = build_task_request(rows)
+
+    # add the encoded content of the file object to the files parameter 
+    files={}
+    files['inputFile']=file_content.encode('utf-8')
+    try:
+
+        with task_lock(payload['taskName']):
+            # a retried batch gets the task created by the first attempt
+            task=TASK_IDEMPOTENCY_CACHE.get(payload['taskName'])
+            task_replayed=task is not None
+
+            api_response_time_ms=0
+            if not task_replayed:
+                api_begin_ts=time.time()
+                response=session.post(url, files=files, data=payload, timeout=timeout)
+                api_end_ts=time.time()
 
+                api_response_time_ms=int((api_end_ts-api_begin_ts)*1000)
+
+                response.raise_for_status()
+
+                task=(response.json())['data']
+                if 'taskId' in task:
+                    TASK_IDEMPOTENCY_CACHE.put(payload['taskName'], task)
+
+        billing_response_time_ms = api_response_time_ms+ssm_response_time_ms
+
+        # collect debug information
+        debug={}
+        debug['api_response_time_ms']=api_response_time_ms
+        debug['billing_response_time_ms']=billing_response_time_ms
+        debug['file']=file_content
+        debug['api_response']=task
+        debug['api_status']=200
+        debug['task_replayed']=task_replayed
+
+        # add task ID and task status to every row; the rowIndex is the position in the task
+        if 'taskId' in task and 'status' in task:
+            batch.set_all('taskId',task['taskId'])
+            batch.set_all('taskStatus',task['status'])
+            for row_index in range(0,len(batch)):
+                batch.set(row_index,'rowIndex',row_index)
+        else:
+            batch.set_all('error',"taskId not found")
+
+        return 200, batch, debug
+
+    except Timeout as err:
+        return 408, "HTTP Timeout: "+ url + " exceeded "+str(timeout)+" seconds", None
+        
+    except Exception as err:
+        return response.status_code, "Error calling "+ url + ": " + response.text, None
+
+
+def lambda_handler(event, context):
+    
+    # 200 is the HTTP status code for "ok".
+    status_code = 200
+    
     try:
         # From the input parameter named "event", get the body, which contains
         # the input rows.
-        event_body = event["body"]
+        event_body = decode_body(event)
  
         # Convert the input from a JSON string into a JSON object.
         payload = json.loads(event_body)
@@ -89,105 +187,16 @@ def lambda_handler(event, context):
         # row number, and a value for each parameter passed to the function.
         
         rows = payload["data"]
-        row_count=len(rows)
         if (len(rows) > MAX_BATCH_ROWS):
             status_code = 400
             json_compatible_string_to_return="Too many rows in batch; Set MAX_BATCH_ROWS="+str(MAX_BATCH_ROWS)
         else:
-        
-            # Get Credentials from Secret Manager
-            ssm_begin_ts=time.time()
-            secret = json.loads(get_secret())
-            ssm_end_ts=time.time()
-            
-            ssm_response_time_ms=int(((ssm_end_ts-ssm_begin_ts)*1000)/row_count)
-            
-            # create a files object, unique identification for the uploaded file 
-            payload={}
-            payload['taskName']='Snowflake_'+uuid.uuid4().hex
-
-            file=io.StringIO(initial_value='',newline='\n')
-
-            # create mapping between filter columns and column names            
-            file.write('row_number')
-            for i in range(0,len(form_names)):
-                file.write(',')
-                payload[form_names[i]]=col_names[i]
-                file.write(col_names[i])
-            
-            # initialize request  object
-            #headers={'Content-Type': 'multipart/form-data;charset=UTF-8', 'Accept': 'application/json'}
-            url='https://api.factset.com/content/factset-concordance/v1/entity-task'
-            session=requests.Session()
-            session.auth=(secret['APIUser'],secret['APIKey'])
-            timeout=(FACTSET_API_READ_TIMEOUT)
-            #session.headers.update={'Content-Type': 'multipart/form-data;charset=UTF-8', 'Accept': 'application/json'}
-            
-            # For each input row in the JSON object...
-            for row in rows:
-                
-                # Read the input row number (the output row number will be the same).
-                file.write('\n')
-                row_number = row[0]
-     
-                # map the row to an output object and also write the values into the
-                # file object send to the API
-                output_row = {}
-                column_count=min(len(col_names)+1,len(row))
-
-                file.write(str(row_number))
-                for i in range(1,column_count):
-                    file.write(',')
-                    if not (row[i] == None):
-                        output_row[col_names[i-1]]=row[i]
-                        file.write('"'+row[i]+'"')
-                
-                # add an output object to the output array
-                array_of_rows_to_return.append([row_number, [output_row]])
-
-            # add the encoded content of the file object to the files parameter 
-            files={}
-            files['inputFile']=(file.getvalue()).encode('utf-8')
-            try:
-
-                api_begin_ts=time.time()
-                response=session.post(url, files=files, data=payload, timeout=timeout)
-                api_end_ts=time.time()
-
-                end_ts=time.time()
-                api_response_time_ms=int((api_end_ts-api_begin_ts)*1000)
-                billing_response_time_ms = api_response_time_ms+ssm_response_time_ms
-                
-                response.raise_for_status()
-
-                # collect debug information
-                array_of_rows_to_return[0][1][0]['debug']={}
-                array_of_rows_to_return[0][1][0]['debug']['api_response_time_ms']=api_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['billing_response_time_ms']=billing_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['file']=file.getvalue()
-                array_of_rows_to_return[0][1][0]['debug']['api_response']=(response.json())['data']
-                array_of_rows_to_return[0][1][0]['debug']['api_status']=200
-
-                # add task ID and task status to every row                 
-                for row_number in range(0,len(array_of_rows_to_return)):
-                    # Read the input row number (the output row number will be the same).
-                    try:
-                        array_of_rows_to_return[row_number][1][0]['taskId']=(response.json())['data']['taskId']
-                        array_of_rows_to_return[row_number][1][0]['taskStatus']=(response.json())['data']['status']
-                        array_of_rows_to_return[row_number][1][0]['rowIndex']=row_number
-                    except:
-                        array_of_rows_to_return[row_number][1][0]['error']="taskId not found"
-
+            status_code, result, debug = post_task(rows)
+            if status_code == 200:
                 # return the results objects    
-                json_compatible_string_to_return = json.dumps({"data" : array_of_rows_to_return})
-
-            except Timeout as err:
-                status_code=408
-                json_compatible_string_to_return="HTTP Timeout: "+ url + " exceeded "+str(timeout)+" seconds"
-                
-            except Exception as err:
-                status_code=response.status_code
-                json_compatible_string_to_return="Error calling "+ url + ": " + response.text
+                json_compatible_string_to_return = result.to_json(debug)
+            else:
+                json_compatible_string_to_return = result
 
     except Exception as err:
         # 400 implies some type of error.
@@ -196,7 +205,4 @@ def lambda_handler(event, context):
         json_compatible_string_to_return = event_body
     
     # Return the return value and HTTP status code.
-    return {
-        'statusCode': status_code,
-        'body': json_compatible_string_to_return,
-    }
+    return encode_response(event, status_code, json_compatible_string_to_return)
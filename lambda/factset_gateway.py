@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import hmac
+import base64
+import signal
+import argparse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import factset_concordance_match_post
+import factset_concordance_route_post
+import factset_concordance_task_post
+import factset_concordance_task_decision_get
+import factset_symbology_post
+
+# The gateway hosts the lambda handlers in one long running process. Requests and
+# responses follow the same Snowflake external function contract as the API
+# Gateway/Lambda deployment; all handlers share the process wide connection pool,
+# credential cache and result caches of factset_api.
+#
+#    python factset_gateway.py --port 8080 --workers 4
+#
+# Each worker is a forked process serving the same listening socket with a pool
+# of threads. Credentials are read from FACTSET_API_USER/FACTSET_API_KEY if set,
+# otherwise from Secrets Manager.
+#
+# The gateway listens on the loopback interface by default. Every request spends
+# the FactSet credentials of the server, so binding to any other interface
+# requires FACTSET_GATEWAY_API_KEY; clients send it in the x-api-key header, like
+# an API Gateway API key.
+
+ROUTES={
+    '/match': factset_concordance_match_post.lambda_handler,
+    '/route': factset_concordance_route_post.lambda_handler,
+    '/task': factset_concordance_task_post.lambda_handler,
+    '/decision': factset_concordance_task_decision_get.lambda_handler,
+    '/symbology': factset_symbology_post.lambda_handler,
+}
+
+API_KEY_HEADER='x-api-key'
+LOOPBACK_HOSTS=('127.0.0.1', '::1', 'localhost')
+
+
+class GatewayRequestHandler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+    # the key clients have to send; None if the gateway is open to local clients
+    api_key=None
+
+    def do_POST(self):
+        if self.api_key is not None and not hmac.compare_digest(
+                self.headers.get(API_KEY_HEADER,'').encode('utf-8'), self.api_key.encode('utf-8')):
+            # the body isn't read; close the connection instead of reusing it
+            self.close_connection=True
+            self.send_result(403, "Forbidden")
+            return
+
+        path=self.path.split('?')[0].rstrip('/')
+        handler=ROUTES.get(path)
+        if handler is None:
+            self.send_result(404, "Unknown function: "+path)
+            return
+
+        content_length=int(self.headers.get('Content-Length',0))
+        body=self.rfile.read(content_length)
+
+        # build an API Gateway proxy event so the handlers can't tell the difference
+        event={}
+        event['path']=path
+        event['httpMethod']='POST'
+        event['headers']=dict(self.headers.items())
+
+        # compressed bodies are passed on base64 encoded, just like API Gateway does
+        if self.headers.get('Content-Encoding','identity') != 'identity':
+            event['body']=base64.b64encode(body).decode('ascii')
+            event['isBase64Encoded']=True
+        else:
+            event['body']=body.decode('utf-8')
+            event['isBase64Encoded']=False
+
+        try:
+            result=handler(event, None)
+        except Exception as err:
+            self.send_result(500, "Internal error: "+str(err))
+            return
+
+        result_body=result['body']
+        if result.get('isBase64Encoded'):
+            result_body=base64.b64decode(result_body)
+        self.send_result(result['statusCode'], result_body, result.get('headers'))
+
+    def send_result(self, status_code, body, headers=None):
+        if isinstance(body, str):
+            body=body.encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if headers:
+            for name, value in headers.items():
+                self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if os.environ.get('FACTSET_GATEWAY_ACCESS_LOG'):
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def serve(host, port, workers, api_key=None):
+    if api_key is None and host not in LOOPBACK_HOSTS:
+        raise SystemExit('binding to '+host+' requires FACTSET_GATEWAY_API_KEY')
+    GatewayRequestHandler.api_key=api_key or None
+
+    server=ThreadingHTTPServer((host, port), GatewayRequestHandler)
+    server.daemon_threads=True
+
+    # prefork the additional workers; they inherit the bound socket. Caches and
+    # sessions are created lazily, i.e. each worker builds its own after the fork
+    children=[]
+    for i in range(1, workers):
+        pid=os.fork()
+        if pid == 0:
+            children=None
+            break
+        children.append(pid)
+
+    def shutdown(signum, frame):
+        if children:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        shutdown(signal.SIGINT, None)
+    finally:
+        server.server_close()
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Serve the FactSet concordance external functions over HTTP')
+    parser.add_argument('--host', default='127.0.0.1',
+        help='interface to listen on; other than loopback requires FACTSET_GATEWAY_API_KEY (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args=parser.parse_args()
+
+    serve(args.host, args.port, max(1, args.workers), os.environ.get('FACTSET_GATEWAY_API_KEY') or None)
+
+
+if __name__ == '__main__':
+    main()
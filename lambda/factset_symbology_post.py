@@ -1,63 +1,36 @@
+import os
 import json
 import time
 
-import boto3
-import base64
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from requests.exceptions import Timeout
+from requests.exceptions import Timeout, HTTPError
 
+from factset_api import get_secret, get_session, api_url, PersistentTTLCache
+from factset_codec import decode_body, encode_response
+from factset_batch import Batch
 
-def get_secret():
+# ids sent in one request body and number of requests sent concurrently
+SYMBOLOGY_CHUNK_SIZE=int(os.environ.get('FACTSET_SYMBOLOGY_CHUNK_SIZE','250'))
+SYMBOLOGY_CONCURRENCY=int(os.environ.get('FACTSET_SYMBOLOGY_CONCURRENCY','4'))
 
-    secret_name = "FactsetAPICredentials"
-    region_name = "us-west-1"
+# resolved ids; tickers and CUSIPs rarely change and daily loads resolve the same
+# universe, so resolutions are kept for a week
+SYMBOLOGY_CACHE=PersistentTTLCache('symbology', int(os.environ.get('FACTSET_SYMBOLOGY_CACHE_TTL',str(7*24*3600))))
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
 
-    # In this sample we only handle the specific exceptions for the 'GetSecretValue' API.
-    # See https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-    # We rethrow the exception by default.
+def post_ids(session, url, ids, headers, timeout):
+    # resolve one chunk of ids; returns the response data and the response time
+    api_begin_ts=time.time()
+    response=session.post(url,data=json.dumps({'ids': ids}),headers=headers,timeout=timeout)
+    api_end_ts=time.time()
+
+    # raise the error in case of http problems
+    response.raise_for_status()
+
+    return (response.json())['data'], int((api_end_ts-api_begin_ts)*1000)
 
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'DecryptionFailureException':
-            # Secrets Manager can't decrypt the protected secret text using the provided KMS key.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InternalServiceErrorException':
-            # An error occurred on the server side.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidParameterException':
-            # You provided an invalid value for a parameter.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'InvalidRequestException':
-            # You provided a parameter value that is not valid for the current state of the resource.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-        elif e.response['Error']['Code'] == 'ResourceNotFoundException':
-            # We can't find the resource that you asked for.
-            # Deal with the exception here, and/or rethrow at your discretion.
-            raise e
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-            
-    return secret 
 
 def lambda_handler(event, context):
  
@@ -69,16 +42,13 @@ def lambda_handler(event, context):
     # 200 is the HTTP status code for "ok".
     status_code = 200
     
-    # The return value will contain an array of arrays (one inner array per input row).
-    array_of_rows_to_return = [ ]
-    
     # Input parameters are mapped to names
     col_names=['id']
  
     try:
         # From the input parameter named "event", get the body, which contains
         # the input rows.
-        event_body = event["body"]
+        event_body = decode_body(event)
  
         # Convert the input from a JSON string into a JSON object.
         payload = json.loads(event_body)
@@ -102,72 +72,76 @@ def lambda_handler(event, context):
             ssm_response_time_ms=int(((ssm_end_ts-ssm_begin_ts)*1000)/row_count)
             
             # initialize request  object and request specific variables
-            session=requests.Session()
-            headers={'Content-type': 'application/json;charset=UTF-', 'Accept': 'application/json'}
-            session.auth=(secret['APIUser'],secret['APIKey'])
+            session=get_session(secret)
+            headers={'Content-type': 'application/json;charset=UTF-8', 'Accept': 'application/json'}
             timeout=(FACTSET_API_READ_TIMEOUT)
-            url='https://api.factset.com/content/symbology/v2/factset'
+            url=api_url('/content/symbology/v2/factset')
             
-           # initialize parameter and output variables
-            result=[]
+            # initialize parameter and output variables; results are keyed by the requested id
+            results={}
             ids=[]
-            
-            params={}
-            params['ids']=ids
      
-            # For each input row in the JSON object...
-            for row in rows:
-                # Read the input row number (the output row number will be the same).
-                row_number = row[0]
-                
-                # prepare an output row 
-                output_row = {}
-                
-                # add all ids for this request into an array
-                ids.append(row[1])
-                
-                # add the requeseted ticker symbol to the output row
-                output_row[col_names[0]]=row[1]
-                
-                # add output row to output array
-                array_of_rows_to_return.append([row_number, [output_row]])
+            # the output rows are kept in a columnar batch and only serialized at the end
+            batch=Batch.from_rows(rows, col_names)
+            requested_ids=batch.columns[0]
+
+            # add all ids not resolved before into an array; null ids aren't sent
+            for requested_id in requested_ids:
+                if requested_id is not None and requested_id not in results:
+                    cached=SYMBOLOGY_CACHE.get(requested_id)
+                    results[requested_id]=cached
+                    if cached is None:
+                        ids.append(requested_id)
                 
             try:
                 
-                # measure time it takes to call the API
-                api_begin_ts=time.time()
-                response=session.get(url,params=params,timeout=timeout)
-                api_end_ts=time.time()
-                
+                # send the ids in chunks in the request body; a query string with
+                # hundreds of ids exceeds the url length limit
+                chunks=[ids[i:i+SYMBOLOGY_CHUNK_SIZE] for i in range(0,len(ids),SYMBOLOGY_CHUNK_SIZE)]
+                api_response=[]
+                api_response_time_ms=0
+                if len(chunks) > 0:
+                    with ThreadPoolExecutor(max_workers=SYMBOLOGY_CONCURRENCY) as executor:
+                        for data, chunk_response_time_ms in executor.map(lambda chunk: post_ids(session, url, chunk, headers, timeout), chunks):
+                            api_response.extend(data)
+                            api_response_time_ms+=chunk_response_time_ms
+
                 end_ts=time.time()
-                api_response_time_ms=int((api_end_ts-api_begin_ts)*1000)
                 billing_response_time_ms = int(api_response_time_ms+ssm_response_time_ms)
 
-                # raise the error in case of http problems
-                response.raise_for_status()
+                # store the results by requested id; only successful resolutions are cached
+                for result in api_response:
+                    results[result.get('requestId')]=result
+                SYMBOLOGY_CACHE.put_many([(result.get('requestId'), result) for result in api_response if not result.get('error')])
                 
                 # collect debug information and them in row 0
-                array_of_rows_to_return[0][1][0]['debug']={}
-                array_of_rows_to_return[0][1][0]['debug']['api_response_time_ms']=api_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['billing_response_time_ms']=billing_response_time_ms
-                array_of_rows_to_return[0][1][0]['debug']['api_response']=(response.json())['data']
-                array_of_rows_to_return[0][1][0]['debug']['api_status']=200
+                debug={}
+                debug['api_response_time_ms']=api_response_time_ms
+                debug['billing_response_time_ms']=billing_response_time_ms
+                debug['api_response']=api_response
+                debug['api_status']=200
+                debug['cached_ids']=len(results)-len(ids)
                 
-                # map the results objects to the output rows
-                result_count=len((response.json())['data'])
-                for row_number in range(0,result_count):
-                    array_of_rows_to_return[row_number][1][0]['response']=((response.json())['data'])[row_number]
-                    array_of_rows_to_return[row_number][1][0]['rowIndex']=row_number
+                # map the results objects to the output rows by the requested id
+                for output_index in range(0,len(batch)):
+                    result=results.get(requested_ids[output_index])
+                    if requested_ids[output_index] is None:
+                        batch.set(output_index, 'error', "id is null")
+                    elif result is not None:
+                        batch.responses[output_index]=result
+                    else:
+                        batch.set(output_index, 'error', "requestId not found")
+                    batch.set(output_index, 'rowIndex', output_index)
 
-                json_compatible_string_to_return = json.dumps({"data" : array_of_rows_to_return})
+                json_compatible_string_to_return = batch.to_json(debug)
                     
             except Timeout as err:
                 status_code=408
                 json_compatible_string_to_return="HTTP Timeout: "+ url + " exceeded "+str(timeout)+" seconds"
                 
-            except Exception as err:
-                status_code=response.status_code
-                json_compatible_string_to_return="Error calling "+ url + ": " + response.text
+            except HTTPError as err:
+                status_code=err.response.status_code
+                json_compatible_string_to_return="Error calling "+ url + ": " + err.response.text
             
     except Exception as err:
         # 400 implies some type of error.
@@ -176,7 +150,4 @@ def lambda_handler(event, context):
         json_compatible_string_to_return = str(err) #event_body
     
     # Return the return value and HTTP status code.
-    return {
-        'statusCode': status_code,
-        'body': json_compatible_string_to_return
-    }
\ No newline at end of file
+    return encode_response(event, status_code, json_compatible_string_to_return)
\ No newline at end of file
@@ -29,6 +29,12 @@ $$
 //                       I_METHOD_PARAM_1: Concordance table
 //                       I_METHOD_PARAM_2: db.schema.external_function
 //
+//                COMPACT: 
+//                   Parameters:
+//                       I_METHOD: 'COMPACT'
+//                       I_METHOD_PARAM_1: Concordance table
+//                       I_METHOD_PARAM_2: retention in days (default 7)
+//
 //             Process coordination is accomplished via the SCHEDULER and the LOG tables.
 //
 //             The statements to be executed are store in JSON format in the input table reference passed as METHOD_PARAMETER_4 
@@ -54,6 +60,9 @@ const EXTERNAL_FUNCTION=I_METHOD_PARAM_2;
 const METHOD_CONF="CONF";
 const METHOD_POST="POST";
 const METHOD_GET="GET";
+const METHOD_COMPACT="COMPACT";
+
+const DEFAULT_RETENTION_DAYS=7;
 
 const REQUEST_TYPE_TASK="TASK";
 const REQUEST_TYPE_DECISION="DECISION"
@@ -63,6 +72,7 @@ const STATUS_PENDING="PENDING";
 const STATUS_COMPLETED="COMPLETED";
 const STATUS_MAPPED="MAPPED";
 const STATUS_REVIEW="REVIEW";
+const STATUS_FAILED="FAILED";
 
 const STATUS_BEGIN= "BEGIN";
 const STATUS_END = "END";
@@ -73,8 +83,12 @@ const CONCORDANCE_INTERFACE_TABLE=CONCORDANCE_TABLE+"_INTERFACE";
 const CONCORDANCE_INTERFACE_TABLE_STATUS=CONCORDANCE_INTERFACE_TABLE+"_STATUS";
 const CONCORDANCE_TABLE_STREAM=CONCORDANCE_TABLE+"_STREAM";
 const CONCORDANCE_INTERFACE_TABLE_STREAM=CONCORDANCE_INTERFACE_TABLE+"_STREAM";
+const CONCORDANCE_INTERFACE_LATEST_TABLE=CONCORDANCE_INTERFACE_TABLE+"_LATEST";
+const CONCORDANCE_INTERFACE_LATEST_STREAM=CONCORDANCE_INTERFACE_LATEST_TABLE+"_STREAM";
 
 const CONCORDANCE_INTERFACE=CONCORDANCE_TABLE+"_INTERFACE";
+const CONCORDANCE_REQUESTS_TABLE=CONCORDANCE_TABLE+"_REQUESTS";
+const CONCORDANCE_POSTED_TABLE=CONCORDANCE_TABLE+"_POSTED";
 
 // Global Variables
 var current_database="";
@@ -177,13 +191,18 @@ function init () {
 }
 
 // -----------------------------------------------------------------------------
-//  this functions creates all tables, views, streams required 
+//  this functions creates all tables, views, streams required; it can be run
+//    again on an existing installation, missing columns and objects are added
+//    and the tuple hash of existing rows is backfilled
+//  the tables are clustered on the first two characters of the tuple hash,
+//    i.e. 256 distinct values; clustering on the full hash would keep
+//    reclustering every micro partition the loads touch
 // -----------------------------------------------------------------------------
 function concordance_configure() {
     log ("CONFIGURE")
     
     sqlquery=`
-        CREATE TABLE `+CONCORDANCE_TABLE+` (
+        CREATE TABLE IF NOT EXISTS `+CONCORDANCE_TABLE+` (
             id integer identity (0,1)
             ,name varchar 
             ,country varchar 
@@ -192,18 +211,21 @@ function concordance_configure() {
             ,map_status varchar
             ,entity_id varchar
             ,status varchar default '`+STATUS_REQUESTED+`'
+            ,tuple_hash varchar
             ,last_modified_ts timestamp default current_timestamp()
             ,create_ts timestamp default current_timestamp())
     `;
     snowflake.execute({sqlText: sqlquery});
 
+    concordance_upgrade_table(CONCORDANCE_TABLE);
+
     sqlquery=`
-        CREATE OR REPLACE STREAM `+CONCORDANCE_TABLE_STREAM+` ON TABLE `+CONCORDANCE_TABLE+`
+        CREATE STREAM IF NOT EXISTS `+CONCORDANCE_TABLE_STREAM+` ON TABLE `+CONCORDANCE_TABLE+`
     `;
     snowflake.execute({sqlText: sqlquery});
 
     sqlquery=`
-        CREATE OR REPLACE TABLE `+CONCORDANCE_INTERFACE_TABLE+` (
+        CREATE TABLE IF NOT EXISTS `+CONCORDANCE_INTERFACE_TABLE+` (
             id integer identity (0,1)
             ,request_type varchar not null
             ,name varchar 
@@ -215,30 +237,84 @@ function concordance_configure() {
             ,status varchar
             ,map_status varchar
             ,entity_id varchar
+            ,tuple_hash varchar
             ,concordance variant
             ,create_ts timestamp default current_timestamp())
     `;
     snowflake.execute({sqlText: sqlquery});
 
+    concordance_upgrade_table(CONCORDANCE_INTERFACE_TABLE);
+
+    sqlquery=`
+        CREATE STREAM IF NOT EXISTS `+CONCORDANCE_INTERFACE_TABLE_STREAM+` ON TABLE `+CONCORDANCE_INTERFACE_TABLE+`
+    `;
+    snowflake.execute({sqlText: sqlquery});
+
+    // latest state per tuple; maintained incrementally from a second stream
+    // on the interface table so the history never has to be scanned
+    sqlquery=`
+        CREATE TABLE IF NOT EXISTS `+CONCORDANCE_INTERFACE_LATEST_TABLE+` (
+            interface_id integer
+            ,request_type varchar not null
+            ,name varchar 
+            ,country varchar 
+            ,state varchar
+            ,website varchar
+            ,task_id varchar
+            ,task_index varchar
+            ,status varchar
+            ,map_status varchar
+            ,entity_id varchar
+            ,tuple_hash varchar
+            ,concordance variant
+            ,create_ts timestamp)
+        CLUSTER BY (substr(tuple_hash,1,2))
+    `;
+    snowflake.execute({sqlText: sqlquery});
+
     sqlquery=`
-        CREATE OR REPLACE STREAM `+CONCORDANCE_INTERFACE_TABLE_STREAM+` ON TABLE `+CONCORDANCE_INTERFACE_TABLE+`
+        CREATE STREAM IF NOT EXISTS `+CONCORDANCE_INTERFACE_LATEST_STREAM+` ON TABLE `+CONCORDANCE_INTERFACE_TABLE+`
     `;
     snowflake.execute({sqlText: sqlquery});
 
+    // a new stream only sees rows added from now on; seed the latest state
+    // from the history already in the interface table
+    concordance_refresh_latest(CONCORDANCE_INTERFACE_TABLE);
+
     sqlquery=`
         CREATE OR REPLACE VIEW `+CONCORDANCE_INTERFACE_TABLE_STATUS+` AS
-            WITH tasks AS (
-                SELECT *
-                FROM `+CONCORDANCE_INTERFACE_TABLE+` 
-                QUALIFY 1=(row_number() over (partition by name,country,state,website order by create_ts desc))
-            ) 
             SELECT * 
-            FROM tasks
+            FROM `+CONCORDANCE_INTERFACE_LATEST_TABLE+`
             ORDER BY task_id::int,task_index::int
     `;
     snowflake.execute({sqlText: sqlquery});
 }
 
+// -----------------------------------------------------------------------------
+//  add the tuple hash to a table created by an earlier version, backfill it
+//    for existing rows and set the clustering key
+// -----------------------------------------------------------------------------
+function concordance_upgrade_table(table) {
+    sqlquery=`
+        ALTER TABLE `+table+` ADD COLUMN IF NOT EXISTS tuple_hash varchar
+    `;
+    snowflake.execute({sqlText: sqlquery});
+
+    sqlquery=`
+        UPDATE `+table+`
+            SET tuple_hash=`+tuple_hash()+`
+            WHERE tuple_hash is null
+    `;
+    var backfilled_count=execute_dml(sqlquery);
+
+    log("TUPLE HASH BACKFILLED "+table+": "+backfilled_count)
+
+    sqlquery=`
+        ALTER TABLE `+table+` CLUSTER BY (substr(tuple_hash,1,2))
+    `;
+    snowflake.execute({sqlText: sqlquery});
+}
+
 // -----------------------------------------------------------------------------
 //  parse the input parameter into 3 parts, 
 //    i.e. database, schema, and object 
@@ -257,38 +333,249 @@ function parse_path(ipath) {
     }
     return result; 
 }
+
+// -----------------------------------------------------------------------------
+//  return the sql expression for the normalized hash of the tuple
+//    (name,country,state,website); values are trimmed and upper cased
+//    so that the same company maps to the same hash 
+// -----------------------------------------------------------------------------
+function tuple_hash(alias) {
+    var prefix=(alias) ? alias+'.' : '';
+    return `sha1(upper(trim(nvl(`+prefix+`name,'')))
+                ||'|'||upper(trim(nvl(`+prefix+`country,'')))
+                ||'|'||upper(trim(nvl(`+prefix+`state,'')))
+                ||'|'||upper(trim(nvl(`+prefix+`website,''))))`;
+}
+
+// -----------------------------------------------------------------------------
+//  execute a DML statement and return the number of rows affected; the result
+//    has one column per kind of change, e.g. "number of rows inserted" and
+//    "number of rows updated" for a MERGE, all of them are added up. Columns
+//    like "number of multi-joined rows updated" are a subset and not counted
+// -----------------------------------------------------------------------------
+function execute_dml(sqlquery) {
+    var stmt=snowflake.createStatement({sqlText: sqlquery});
+    var ResultSet=stmt.execute();
+    var row_count=0;
+    if (ResultSet.next()) {
+        for (var i=1; i <= stmt.getColumnCount(); i++) {
+            if (stmt.getColumnName(i).toLowerCase().indexOf("number of rows") == 0) {
+                row_count+=ResultSet.getColumnValue(i);
+            }
+        }
+    }
+    return row_count;
+}
+// -----------------------------------------------------------------------------
+// merge all rows added to the interface table since the last refresh into
+//   the latest state table; only the most recent row per tupel is kept
+// the source defaults to the stream; configure passes the interface table
+//   itself to seed the latest state from the full history
+// update records (e.g. the tuple hash backfill of an upgrade) are not new
+//   states and are skipped
+// -----------------------------------------------------------------------------
+function concordance_refresh_latest(source) {
+    var source_filter=(source) ? "" : "WHERE METADATA$ACTION='INSERT' AND NOT METADATA$ISUPDATE";
+    source=(source) ? source : CONCORDANCE_INTERFACE_LATEST_STREAM;
+
+    sqlquery=`
+        MERGE INTO `+CONCORDANCE_INTERFACE_LATEST_TABLE+` t
+            USING (
+                SELECT id, request_type, name, country, state, website, task_id, task_index
+                    ,status, map_status, entity_id, tuple_hash, concordance, create_ts
+                FROM `+source+`
+                `+source_filter+`
+                QUALIFY 1=(row_number() over (partition by tuple_hash order by create_ts desc, id desc))) s
+            ON t.tuple_hash=s.tuple_hash
+            WHEN MATCHED AND s.create_ts>=t.create_ts
+                THEN UPDATE SET t.interface_id=s.id, t.request_type=s.request_type
+                                ,t.name=s.name, t.country=s.country, t.state=s.state, t.website=s.website
+                                ,t.task_id=s.task_id, t.task_index=s.task_index, t.status=s.status
+                                ,t.map_status=s.map_status, t.entity_id=s.entity_id
+                                ,t.concordance=s.concordance, t.create_ts=s.create_ts
+            WHEN NOT MATCHED 
+                THEN INSERT (interface_id, request_type, name, country, state, website, task_id, task_index
+                            ,status, map_status, entity_id, tuple_hash, concordance, create_ts) 
+                    VALUES (s.id, s.request_type, s.name, s.country, s.state, s.website, s.task_id, s.task_index
+                            ,s.status, s.map_status, s.entity_id, s.tuple_hash, s.concordance, s.create_ts)
+    `;
+    var merged_count=execute_dml(sqlquery);
+
+    log("LATEST STATE REFRESHED: "+merged_count)
+}
+
 // -----------------------------------------------------------------------------
 // read tuple (name,country,state,website) from the input table and 
 //   request a company match by calling the FACTSET Task API (batch). The API
 //   returns a Task ID and rowIndex for each tupel
+// tupel already resolved in a previous run (status COMPLETED in the concordance
+//   or the interface table) are resolved immediately and tupel waiting for a
+//   decision of an open task (status PENDING) join that task; neither is sent
+//   to FACTSET. Of the remaining tupel each is posted once, however often it
+//   was requested
+// the stream is consumed in the same transaction as the external function
+//   call; if the call fails the transaction is rolled back and the requested
+//   rows are picked up again by the next POST
+// rows answered with a mapStatus (route MATCH of the routing function) are
+//   recorded as decided right away; rows answered with a taskId are PENDING
 // -----------------------------------------------------------------------------
 function concordance_task_post(external_function) {
     const FULLY_QUALIFIED_PATH=parse_path(external_function);
 
     log("CREATE REQUESTS")
 
+    sqlquery=`
+        CREATE OR REPLACE TEMPORARY TABLE `+CONCORDANCE_REQUESTS_TABLE+` (
+            id integer
+            ,name varchar 
+            ,country varchar 
+            ,state varchar
+            ,website varchar
+            ,tuple_hash varchar
+            ,status varchar
+            ,map_status varchar
+            ,entity_id varchar)
+    `;
+    snowflake.execute({sqlText: sqlquery});
+
+    // results of the external function for the posted rows; like the requests
+    // table it is created up front since DDL commits an open transaction
+    sqlquery=`
+        CREATE OR REPLACE TEMPORARY TABLE `+CONCORDANCE_POSTED_TABLE+` (
+            id integer
+            ,tuple_hash varchar
+            ,concordance variant)
+    `;
+    snowflake.execute({sqlText: sqlquery});
+
+    snowflake.execute({sqlText: "BEGIN TRANSACTION"});
+    try {
+        concordance_task_post_requests(FULLY_QUALIFIED_PATH);
+        snowflake.execute({sqlText: "COMMIT"});
+    } catch (ERROR) {
+        snowflake.execute({sqlText: "ROLLBACK"});
+        throw ERROR;
+    }
+
+    concordance_refresh_latest();
+}
+
+// -----------------------------------------------------------------------------
+// the steps of a POST executed within the transaction; all steps work off the
+//   copy of the requested rows taken from the stream. The concordance table is
+//   only written after the external function returned so that it isn't locked
+//   for the duration of the upload
+// -----------------------------------------------------------------------------
+function concordance_task_post_requests(fully_qualified_path) {
+    sqlquery=`
+        INSERT INTO `+CONCORDANCE_REQUESTS_TABLE+` (id,name,country,state,website,tuple_hash)
+            SELECT id,name,country,state,website,`+tuple_hash()+`
+            FROM  `+CONCORDANCE_TABLE_STREAM+`
+            WHERE STATUS='`+STATUS_REQUESTED+`'
+                AND NAME is not null 
+                AND METADATA$ACTION='INSERT'
+                AND NOT METADATA$ISUPDATE
+    `;
+    var requested_count=execute_dml(sqlquery);
+
+    log("REQUESTED: "+requested_count)
+
+    sqlquery=`
+        UPDATE `+CONCORDANCE_REQUESTS_TABLE+` r
+            SET r.status=k.status, r.map_status=k.map_status, r.entity_id=k.entity_id
+            FROM (
+                SELECT tuple_hash, status, map_status, entity_id
+                FROM (
+                    SELECT tuple_hash, status, map_status, entity_id, last_modified_ts ts
+                    FROM `+CONCORDANCE_TABLE+`
+                    WHERE status='`+STATUS_COMPLETED+`'
+                        AND tuple_hash IN (SELECT tuple_hash FROM `+CONCORDANCE_REQUESTS_TABLE+`)
+                    UNION ALL
+                    SELECT tuple_hash, status, map_status, entity_id, create_ts ts
+                    FROM `+CONCORDANCE_INTERFACE_LATEST_TABLE+`
+                    WHERE ((request_type='`+REQUEST_TYPE_DECISION+`' AND status='`+STATUS_COMPLETED+`')
+                            OR status='`+STATUS_PENDING+`')
+                        AND tuple_hash IN (SELECT tuple_hash FROM `+CONCORDANCE_REQUESTS_TABLE+`))
+                QUALIFY 1=(row_number() over (partition by tuple_hash order by ts desc))
+            ) k
+            WHERE r.tuple_hash=k.tuple_hash
+    `;
+    var resolved_count=execute_dml(sqlquery);
+
+    log("SKIPPED (ALREADY RESOLVED OR PENDING): "+resolved_count)
+
+    // one row per new tupel; the external function is only called on the
+    // deduplicated rows of the subquery
+    sqlquery=`
+        INSERT INTO `+CONCORDANCE_POSTED_TABLE+` (id, tuple_hash, concordance)
+            SELECT id, tuple_hash, `+fully_qualified_path+`(name, country, state, website)[0] concordance
+            FROM (
+                SELECT id, name, country, state, website, tuple_hash
+                FROM  `+CONCORDANCE_REQUESTS_TABLE+`
+                WHERE status is null
+                QUALIFY 1=(row_number() over (partition by tuple_hash order by id)))
+    `;
+    var posted_count=execute_dml(sqlquery);
+
     sqlquery=`
         INSERT INTO `+CONCORDANCE_INTERFACE_TABLE+`
-                (request_type,name,country,state,website,task_id, task_index,status, concordance )
-            SELECT '`+REQUEST_TYPE_TASK+`' request_type
+                (request_type,name,country,state,website,task_id, task_index,status,map_status,entity_id,tuple_hash, concordance )
+            SELECT case when (concordance:"mapStatus"::varchar) is null then '`+REQUEST_TYPE_TASK+`'
+                        else '`+REQUEST_TYPE_DECISION+`' end request_type
                 ,concordance:"name"::varchar requested_name
                 ,concordance:"country"::varchar requested_country
                 ,concordance:"state"::varchar requested_state
                 ,concordance:"url"::varchar requested_url
                 ,concordance:"taskId"::varchar task_id
                 ,concordance:"rowIndex"::int task_index
-                ,concordance:"taskStatus"::varchar status
+                ,case when (concordance:"mapStatus"::varchar) is null then concordance:"taskStatus"::varchar
+                        when (concordance:"mapStatus"::varchar)='`+STATUS_MAPPED+`' then '`+STATUS_COMPLETED+`' 
+                        else '`+STATUS_REVIEW+`' end status
+                ,concordance:"mapStatus"::varchar map_status
+                ,concordance:"entityId"::varchar entity_id
+                ,tuple_hash
                 ,concordance
-            FROM (
-                SELECT `+FULLY_QUALIFIED_PATH+`(name, country, state,website)[0] concordance
-                FROM  `+CONCORDANCE_TABLE_STREAM+`
-                WHERE STATUS='`+STATUS_REQUESTED+`'
-                    AND NAME is not null 
-                    AND METADATA$ACTION='INSERT')
+            FROM `+CONCORDANCE_POSTED_TABLE+`
+    `;
+    snowflake.execute({sqlText: sqlquery});
+
+    // copy the mapping of already resolved tupel; tupel of an open task are
+    // PENDING and receive the decision of that task by tuple hash
+    sqlquery=`
+        UPDATE `+CONCORDANCE_TABLE+` t
+            SET t.tuple_hash=r.tuple_hash
+                ,t.status=r.status, t.map_status=r.map_status
+                ,t.entity_id=r.entity_id, last_modified_ts=current_timestamp()
+            FROM `+CONCORDANCE_REQUESTS_TABLE+` r
+            WHERE t.id=r.id
+                AND r.status is not null
     `;
     snowflake.execute({sqlText: sqlquery});
 
+    // rows with a task are PENDING from now on, matched rows are decided; they
+    // no longer match the REQUESTED filter and are never posted a second time.
+    // The result of a posted tupel applies to all rows requesting that tupel
+    sqlquery=`
+        UPDATE `+CONCORDANCE_TABLE+` t
+            SET t.tuple_hash=p.tuple_hash
+                ,t.status=case when (p.concordance:"mapStatus"::varchar) is null then '`+STATUS_PENDING+`'
+                        when (p.concordance:"mapStatus"::varchar)='`+STATUS_MAPPED+`' then '`+STATUS_COMPLETED+`' 
+                        else '`+STATUS_REVIEW+`' end
+                ,t.map_status=p.concordance:"mapStatus"::varchar
+                ,t.entity_id=p.concordance:"entityId"::varchar
+                ,last_modified_ts=current_timestamp()
+            FROM (
+                SELECT r.id, p.tuple_hash, p.concordance
+                FROM `+CONCORDANCE_REQUESTS_TABLE+` r
+                JOIN `+CONCORDANCE_POSTED_TABLE+` p ON r.tuple_hash=p.tuple_hash
+                WHERE r.status is null) p
+            WHERE t.id=p.id
+                AND (p.concordance:"taskId" is not null
+                    OR p.concordance:"mapStatus" is not null)
+    `;
+    snowflake.execute({sqlText: sqlquery});
 
+    log("POSTED: "+posted_count)
 }
 
 // -----------------------------------------------------------------------------
@@ -296,21 +583,23 @@ function concordance_task_post(external_function) {
 //    decision API (batch); 
 // for all tupel with a decision, i.e. status is no longer PENDING, merge the 
 //    decision into the input table 
+// tupel of a task that ended without decisions (the response has an error)
+//    are FAILED and no longer polled; requesting the tupel again posts it in
+//    a new task
 // -----------------------------------------------------------------------------
 function concordance_task_get(external_function) {
     const FULLY_QUALIFIED_PATH=parse_path(external_function);
 
     log("GET DECISIONS")
 
+    concordance_refresh_latest();
+
     sqlquery=`
         INSERT INTO `+CONCORDANCE_INTERFACE_TABLE+`
-                (request_type,name,country,state,website,task_id, task_index,status,map_status,entity_id, concordance )
+                (request_type,name,country,state,website,task_id, task_index,status,map_status,entity_id,tuple_hash, concordance )
             WITH tasks AS (
-                SELECT * 
-                FROM (
-                    SELECT request_type, name, country, state,website,task_id,task_index, status
-                    FROM  `+CONCORDANCE_INTERFACE_TABLE+` 
-                    QUALIFY 1=(row_number() over (partition by task_id, task_index order by create_ts desc)))
+                SELECT request_type, name, country, state,website,task_id,task_index, status, tuple_hash
+                FROM  `+CONCORDANCE_INTERFACE_LATEST_TABLE+` 
                 WHERE status = '`+STATUS_PENDING+`'
             )
             SELECT '`+REQUEST_TYPE_DECISION+`' request_type
@@ -320,43 +609,88 @@ function concordance_task_get(external_function) {
                 ,concordance:"url"::varchar requested_url
                 ,concordance:"taskId"::varchar task_id
                 ,concordance:"rowIndex"::int task_index
-                ,case when (concordance:"response"[0]."mapStatus"::varchar) is null then '`+STATUS_PENDING+`'
+                ,case when (concordance:"response"[0]."error"::varchar) is not null then '`+STATUS_FAILED+`'
+                        when (concordance:"response"[0]."mapStatus"::varchar) is null then '`+STATUS_PENDING+`'
                         when (concordance:"response"[0]."mapStatus"::varchar)='`+STATUS_MAPPED+`' then '`+STATUS_COMPLETED+`' 
                         else '`+STATUS_REVIEW+`' end  status
                 ,concordance:"response"[0]."mapStatus"::varchar map_status
                 ,concordance:"response"[0]."entityId"::varchar entity_id     
+                ,tuple_hash
                 ,concordance
             FROM (  
-                SELECT `+FULLY_QUALIFIED_PATH+`(name, country, state,website,task_id,task_index)[0] concordance
+                SELECT `+FULLY_QUALIFIED_PATH+`(name, country, state,website,task_id,task_index)[0] concordance, tuple_hash
                 FROM tasks 
                 ORDER BY task_id, task_index
             )
     `;
     snowflake.execute({sqlText: sqlquery});
 
+    concordance_merge_decisions();
+
+    concordance_refresh_latest();
+}
+
+// -----------------------------------------------------------------------------
+// merge all decisions added to the interface table since the last merge into
+//   the concordance table; the most recent decision per tupel wins, update
+//   records (e.g. the tuple hash backfill of an upgrade) are skipped
+// -----------------------------------------------------------------------------
+function concordance_merge_decisions() {
     sqlquery=`
         MERGE INTO `+CONCORDANCE_TABLE+` t
             USING ( 
-              SELECT name,country,state,website, status, map_status, entity_id
+              SELECT name,country,state,website, status, map_status, entity_id, tuple_hash
               FROM (
-                SELECT name,country,state,website, status, map_status, entity_id, task_id, task_index
+                SELECT id, name,country,state,website, status, map_status, entity_id, tuple_hash, task_id, task_index, create_ts
                 FROM `+CONCORDANCE_INTERFACE_TABLE_STREAM+`
                 WHERE request_type='`+REQUEST_TYPE_DECISION+`' 
-                    AND METADATA$ACTION='INSERT')
-              QUALIFY 1=ROW_NUMBER() OVER (PARTITION BY name,country,state,website ORDER BY status, map_status, entity_id)) s
-            ON t.name=s.name 
-                AND nvl(t.country,'')=nvl(s.country,'') 
-                AND nvl(t.state,'')=nvl(s.state,'') 
-                AND nvl(t.website,'')=nvl(s.website,'') 
-                AND nvl(t.name,'')=nvl(s.name,'')
+                    AND METADATA$ACTION='INSERT'
+                    AND NOT METADATA$ISUPDATE)
+              QUALIFY 1=ROW_NUMBER() OVER (PARTITION BY tuple_hash ORDER BY create_ts desc, id desc)) s
+            ON t.tuple_hash=s.tuple_hash
             WHEN MATCHED 
                 THEN UPDATE SET t.map_status=s.map_status, t.entity_id = s.entity_id
                                 ,t.status=s.status, last_modified_ts=current_timestamp()
             WHEN NOT MATCHED 
-                THEN INSERT (name,country,state,website, status, map_status , entity_id) 
-                    VALUES (s.name,s.country,s.state,s.website, s.status, s.map_status, s.entity_id )
+                THEN INSERT (name,country,state,website, status, map_status , entity_id, tuple_hash) 
+                    VALUES (s.name,s.country,s.state,s.website, s.status, s.map_status, s.entity_id, s.tuple_hash )
     `;
-    snowflake.execute({sqlText: sqlquery});
+    var merged_count=execute_dml(sqlquery);
+
+    log("DECISIONS MERGED: "+merged_count)
+}
+
+// -----------------------------------------------------------------------------
+// remove all rows from the interface table that are older than the retention
+//    window and have been superseded by a newer row for the same tupel; the
+//    latest state of every tupel is always kept
+// decisions not merged into the concordance table yet are merged first, the
+//    deleted rows would otherwise never reach the merge; rows without a tuple
+//    hash are kept
+// -----------------------------------------------------------------------------
+function concordance_compact(retention_days) {
+    var days=parseInt(retention_days);
+    if (isNaN(days) || days < 0) {
+        days=DEFAULT_RETENTION_DAYS;
+    }
+
+    log("COMPACT RETENTION DAYS: "+days)
+
+    concordance_merge_decisions();
+    concordance_refresh_latest();
+
+    sqlquery=`
+        DELETE FROM `+CONCORDANCE_INTERFACE_TABLE+` i
+            WHERE i.create_ts < dateadd(day,-`+days+`,current_timestamp())
+                AND i.tuple_hash is not null
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM `+CONCORDANCE_INTERFACE_LATEST_TABLE+` l
+                    WHERE l.interface_id=i.id)
+    `;
+    var deleted_count=execute_dml(sqlquery);
+
+    log("COMPACTED: "+deleted_count)
 }
 
 // -----------------------------------------------------------------------------
@@ -376,8 +710,10 @@ try {
         concordance_task_post(EXTERNAL_FUNCTION)
     } else if (METHOD==METHOD_GET) {
         concordance_task_get(EXTERNAL_FUNCTION)
+    } else if (METHOD==METHOD_COMPACT) {
+        concordance_compact(I_METHOD_PARAM_2)
     } else {
-        throw new Error("REQUESTED METHOD NOT FOUND: "+METHOD+"; ALLOWED VALUES "+METHOD_CONF+","+METHOD_POST+","+METHOD_GET);
+        throw new Error("REQUESTED METHOD NOT FOUND: "+METHOD+"; ALLOWED VALUES "+METHOD_CONF+","+METHOD_POST+","+METHOD_GET+","+METHOD_COMPACT);
     }
 
     log("procName: " + procName + " " + STATUS_END);
@@ -0,0 +1,145 @@
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+import factset_stub
+
+# Benchmark the gateway server against the local FactSet stand-in. The stand-in
+# runs in this process, the gateway in a child process with the given number of
+# workers. Every function is called with Snowflake sized batches from a pool of
+# concurrent clients; the first round runs with cold caches, the second round
+# repeats the same batches and the third round repeats them with gzip compressed
+# request and response bodies. Repeated task batches are answered from the
+# idempotency cache without an upload, so the task rounds send new rows instead
+# and the repeated batches are reported as a separate replay round.
+#
+#    python bench_gateway.py --workers 4 --concurrency 16 --requests 64 > ../bench_output.txt
+
+LAMBDA_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','lambda')
+
+COMPANIES=[('Tesla Inc.','US',None,'www.tesla.com'),('Snowflake','US',None,'www.snowflake.com'),('AT&T','US',None,'www.att.com')]
+
+
+def company_rows(count, offset=0):
+    rows=[]
+    for i in range(0,count):
+        name,country,state,url=COMPANIES[(offset+i) % len(COMPANIES)]
+        rows.append([i, name+' '+str(offset+i), country, state, url])
+    return rows
+
+
+def call(port, function, rows, compress=False):
+    # returns latency, response, request bytes and response bytes
+    body=json.dumps({'data': rows}).encode('utf-8')
+    headers={}
+    if compress:
+        body=gzip.compress(body)
+        headers['Content-Encoding']='gzip'
+        headers['Accept-Encoding']='gzip'
+    request=urllib.request.Request('http://127.0.0.1:'+str(port)+'/'+function, data=body, headers=headers, method='POST')
+
+    begin_ts=time.time()
+    with urllib.request.urlopen(request) as response:
+        response_body=response.read()
+        response_bytes=len(response_body)
+        if response.headers.get('Content-Encoding') == 'gzip':
+            response_body=gzip.decompress(response_body)
+    return (time.time()-begin_ts)*1000, json.loads(response_body), len(body), response_bytes
+
+
+def run_round(port, function, batches, concurrency, compress=False):
+    begin_ts=time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results=list(executor.map(lambda rows: call(port, function, rows, compress), batches))
+    elapsed=time.time()-begin_ts
+
+    latencies=sorted(result[0] for result in results)
+    row_count=sum(len(rows) for rows in batches)
+    return {
+        'requests': len(batches),
+        'rows_per_s': int(row_count/elapsed),
+        'p50_ms': int(statistics.median(latencies)),
+        'p95_ms': int(latencies[min(len(latencies)-1,int(len(latencies)*0.95))]),
+        'request_bytes_per_batch': int(sum(result[2] for result in results)/len(results)),
+        'response_bytes_per_batch': int(sum(result[3] for result in results)/len(results)),
+    }, [result[1] for result in results]
+
+
+def wait_for(port, timeout=10):
+    deadline=time.time()+timeout
+    while time.time() < deadline:
+        try:
+            call(port, 'match', company_rows(1))
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError('gateway did not start on port '+str(port))
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Benchmark the gateway against the FactSet stand-in')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--latency-ms', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8081)
+    args=parser.parse_args()
+
+    stub=factset_stub.start(latency_ms=args.latency_ms)
+
+    env=dict(os.environ)
+    env['FACTSET_API_BASE_URL']='http://127.0.0.1:'+str(stub.server_address[1])
+    env['FACTSET_API_USER']='bench'
+    env['FACTSET_API_KEY']='bench'
+    # persistent caches start empty; task ids replayed from an earlier run are unknown to this stand-in
+    env['FACTSET_CACHE_DIR']=tempfile.mkdtemp(prefix='factset_bench_')
+    gateway=subprocess.Popen([sys.executable, os.path.join(LAMBDA_DIR,'factset_gateway.py'),
+        '--host','127.0.0.1','--port',str(args.port),'--workers',str(args.workers)], env=env)
+
+    try:
+        wait_for(args.port)
+
+        match_batches=[company_rows(25, offset=i*25) for i in range(0,args.requests)]
+        task_count=max(1,args.requests//8)
+        # every task round uploads rows not posted before
+        task_batches=[[company_rows(1000, offset=(j*task_count+i)*1000) for i in range(0,task_count)] for j in range(0,2)]
+        symbology_batches=[[[i, 'TICKER'+str(j*1000+i)] for i in range(0,1000)] for j in range(0,max(1,args.requests//8))]
+
+        print('workers='+str(args.workers)+' concurrency='+str(args.concurrency)+' api_latency_ms='+str(args.latency_ms))
+        last_responses={}
+        rounds=[('cold', False, None), ('warm', False, None), ('gzip', True, None)]
+        task_rounds=[('cold', False, task_batches[0]), ('gzip', True, task_batches[1]), ('replay', False, task_batches[0])]
+        for function, batches, function_rounds in (('match', match_batches, rounds), ('task', None, task_rounds), ('symbology', symbology_batches, rounds)):
+            for round_name, compress, round_batches in function_rounds:
+                stats, last_responses[function]=run_round(args.port, function, round_batches or batches, args.concurrency, compress)
+                print(function.ljust(10)+round_name.ljust(7)+json.dumps(stats))
+
+        # poll decisions for the tasks created above, 250 rows per call like a Snowflake batch
+        decision_batches=[]
+        for response in last_responses['task']:
+            rows=[]
+            for row_number, row in response['data']:
+                output_row=row[0]
+                rows.append([row_number, output_row.get('name'), output_row.get('country'), output_row.get('state'),
+                    output_row.get('url'), output_row['taskId'], output_row['rowIndex']])
+            decision_batches.extend(rows[i:i+250] for i in range(0,len(rows),250))
+        for round_name, compress in (('cold', False), ('warm', False), ('gzip', True)):
+            stats, last_responses['decision']=run_round(args.port, 'decision', decision_batches, args.concurrency, compress)
+            print('decision'.ljust(10)+round_name.ljust(7)+json.dumps(stats))
+    finally:
+        gateway.terminate()
+        gateway.wait()
+        stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import sys
+import json
+import zlib
+import time
+import argparse
+import threading
+import itertools
+import email.parser
+import email.policy
+
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the FactSet concordance and symbology APIs. It answers with
+# the same response shapes as the real API after an artificial latency, e.g.
+#
+#    python factset_stub.py --port 8090 --latency-ms 150 --task-ms 60000
+#
+# and point the handlers to it with FACTSET_API_BASE_URL=http://localhost:8090
+
+CONCORDANCE_PATH='/content/factset-concordance/v1'
+SYMBOLOGY_PATH='/content/symbology/v2/factset'
+
+LATENCY_MS=100
+# time an entity task takes until all of its rows are decided
+TASK_MS=0
+
+tasks={}
+tasks_lock=threading.Lock()
+task_ids=itertools.count(1000)
+
+
+def entity_id(name):
+    return '0'+format(zlib.crc32(name.upper().encode('utf-8')) % 0xFFFFF, '05X')+'-E'
+
+
+def task_processed(task):
+    # number of rows of a task decided so far
+    if TASK_MS <= 0:
+        return len(task['rows'])
+    elapsed_ms=(time.time()-task['created'])*1000
+    return min(len(task['rows']), int(len(task['rows'])*elapsed_ms/TASK_MS))
+
+
+def match_candidates(row_index, request):
+    name=request.get('name','')
+    return [
+        {'rowIndex': row_index, 'entityId': entity_id(name), 'entityName': name, 'similarityScore': 0.98, 'matchFlag': True},
+        {'rowIndex': row_index, 'entityId': entity_id(name+' Holdings'), 'entityName': name+' Holdings', 'similarityScore': 0.71, 'matchFlag': False},
+    ]
+
+
+def read_input_file(content_type, body):
+    # extract the rows of the uploaded csv file from the multipart form
+    message=email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: '+content_type.encode('utf-8')+b'\r\n\r\n'+body)
+    for part in message.iter_parts():
+        if part.get_param('name', header='content-disposition') == 'inputFile':
+            lines=part.get_payload(decode=True).decode('utf-8').split('\n')
+            return [line.split(',') for line in lines[1:] if line]
+    return []
+
+
+class FactsetStubHandler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+
+    def do_GET(self):
+        self.dispatch('GET', b'')
+
+    def do_POST(self):
+        content_length=int(self.headers.get('Content-Length',0))
+        self.dispatch('POST', self.rfile.read(content_length))
+
+    def dispatch(self, method, body):
+        time.sleep(LATENCY_MS/1000)
+        url=urlparse(self.path)
+        params={name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        if url.path == CONCORDANCE_PATH+'/entity-match' and method == 'POST':
+            data=[]
+            for row_index, request in enumerate(json.loads(body)['input']):
+                data.extend(match_candidates(row_index, request))
+            self.send_json(200, {'data': data})
+
+        elif url.path == CONCORDANCE_PATH+'/entity-task' and method == 'POST':
+            rows=read_input_file(self.headers['Content-Type'], body)
+            task_id=next(task_ids)
+            with tasks_lock:
+                tasks[str(task_id)]={'rows': rows, 'created': time.time()}
+            self.send_json(200, {'data': {'taskId': task_id, 'status': 'PENDING'}})
+
+        elif url.path == CONCORDANCE_PATH+'/entity-decisions' and method == 'GET':
+            with tasks_lock:
+                task=tasks.get(params.get('taskId'))
+            if task is None:
+                self.send_json(404, {'errors': ['taskId not found']})
+                return
+            offset=int(params.get('offset',0))
+            limit=int(params.get('limit',1000))
+            # rows are only decided once the whole task is processed
+            decided=task_processed(task) == len(task['rows'])
+            data=[]
+            for row_index, row in enumerate(task['rows'][offset:offset+limit], start=offset):
+                name=row[1].strip('"') if len(row) > 1 else ''
+                if decided:
+                    data.append({'rowIndex': row_index, 'name': name, 'mapStatus': 'MAPPED', 'entityId': entity_id(name)})
+                else:
+                    data.append({'rowIndex': row_index, 'name': name})
+            self.send_json(200, {'data': data})
+
+        elif url.path == CONCORDANCE_PATH+'/entity-task-status' and method == 'GET':
+            with tasks_lock:
+                task=tasks.get(params.get('taskId'))
+            if task is None:
+                self.send_json(404, {'errors': ['taskId not found']})
+                return
+            processed=task_processed(task)
+            status='SUCCESS' if processed == len(task['rows']) else 'IN_PROGRESS'
+            self.send_json(200, {'data': [{'taskId': params.get('taskId'), 'status': status,
+                'inputRecordCount': len(task['rows']), 'processedRecordCount': processed}]})
+
+        elif url.path == SYMBOLOGY_PATH:
+            if method == 'POST':
+                ids=json.loads(body)['ids']
+            else:
+                ids=parse_qs(url.query).get('ids',[''])[-1].split(',')
+            data=[{'requestId': id, 'fsymId': 'FS'+format(zlib.crc32(id.encode('utf-8')) % 0xFFFFFF, '06X')+'-R'} for id in ids]
+            self.send_json(200, {'data': data})
+
+        else:
+            self.send_json(404, {'errors': ['unknown endpoint '+url.path]})
+
+    def send_json(self, status_code, payload):
+        body=json.dumps(payload).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, latency_ms=LATENCY_MS, task_ms=TASK_MS):
+    # start the stand-in on a background thread and return the server
+    global LATENCY_MS, TASK_MS
+    LATENCY_MS=latency_ms
+    TASK_MS=task_ms
+    server=ThreadingHTTPServer(('127.0.0.1', port), FactsetStubHandler)
+    server.daemon_threads=True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Local stand-in for the FactSet APIs')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=int, default=LATENCY_MS)
+    parser.add_argument('--task-ms', type=int, default=TASK_MS)
+    args=parser.parse_args()
+
+    server=start(args.port, args.latency_ms, args.task_ms)
+    print('FactSet stand-in listening on port '+str(server.server_address[1]))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,58 @@
+import os
+import sys
+import gzip
+import json
+import base64
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','lambda'))
+
+from factset_codec import accepts_encoding, decode_body, encode_response, MIN_COMPRESS_BYTES
+
+# Encoding of request and response bodies at the external function boundary
+#
+#    python -m pytest test/test_codec.py
+
+BODY=json.dumps({'data': [[i, 'Company '+str(i), 'US', None, 'www.example.com'] for i in range(0,100)]})
+
+
+def test_accepts_encoding():
+    assert accepts_encoding('gzip', 'gzip')
+    assert accepts_encoding('deflate, GZIP;q=0.5', 'gzip')
+    assert accepts_encoding('*', 'gzip')
+    assert not accepts_encoding('', 'gzip')
+    assert not accepts_encoding('deflate', 'gzip')
+    assert not accepts_encoding('gzip;q=0', 'gzip')
+    assert not accepts_encoding('gzip; q=0.0, deflate', 'gzip')
+    # an explicit q-value of the coding takes precedence over *
+    assert not accepts_encoding('*, gzip;q=0', 'gzip')
+    assert not accepts_encoding('*;q=0', 'gzip')
+    assert accepts_encoding('*;q=0, gzip', 'gzip')
+
+
+def test_compressed_response_round_trip():
+    assert len(BODY) >= MIN_COMPRESS_BYTES
+    response=encode_response({'headers': {'Accept-Encoding': 'gzip, deflate'}}, 200, BODY)
+    assert response['isBase64Encoded'] and response['headers'] == {'Content-Encoding': 'gzip'}
+
+    # the compressed response decodes to the original body as a compressed request
+    event={'body': response['body'], 'isBase64Encoded': True, 'headers': {'content-encoding': 'gzip'}}
+    assert decode_body(event) == BODY
+
+
+def test_response_is_not_compressed_unless_accepted():
+    for headers in [None, {'Accept-Encoding': 'gzip;q=0'}, {'Accept-Encoding': 'identity'}]:
+        response=encode_response({'headers': headers}, 200, BODY)
+        assert response == {'statusCode': 200, 'body': BODY}
+
+    # small bodies aren't compressed either
+    response=encode_response({'headers': {'Accept-Encoding': 'gzip'}}, 200, '{"data": []}')
+    assert response == {'statusCode': 200, 'body': '{"data": []}'}
+
+
+def test_decode_request_body():
+    assert decode_body({'body': BODY}) == BODY
+    # binary bodies are base64 encoded by API Gateway, compressed or not
+    encoded=base64.b64encode(BODY.encode('utf-8')).decode('ascii')
+    assert decode_body({'body': encoded, 'isBase64Encoded': True}) == BODY
+    compressed=base64.b64encode(gzip.compress(BODY.encode('utf-8'))).decode('ascii')
+    assert decode_body({'body': compressed, 'isBase64Encoded': True, 'headers': {'Content-Encoding': 'gzip'}}) == BODY
@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import uuid
+import tempfile
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+import factset_stub
+
+# Runs the handlers in process against the local FactSet stand-in; unlike the
+# other scripts in this directory no FactSet account is needed.
+#
+#    python -m pytest test/test_stub_handlers.py
+
+STUB=factset_stub.start(latency_ms=0)
+
+os.environ['FACTSET_API_BASE_URL']='http://127.0.0.1:'+str(STUB.server_address[1])
+os.environ['FACTSET_API_USER']='test'
+os.environ['FACTSET_API_KEY']='test'
+os.environ['FACTSET_CACHE_DIR']=tempfile.mkdtemp(prefix='factset_test_')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','lambda'))
+
+import factset_api
+import factset_symbology_post
+import factset_concordance_task_post
+import factset_concordance_match_post
+import factset_concordance_route_post
+import factset_concordance_bulk
+import factset_concordance_task_decision_get
+
+
+def call(handler, rows):
+    result=handler({'body': json.dumps({'data': rows})}, None)
+    assert result['statusCode'] == 200, result['body']
+    return [output[0] for row_number, output in json.loads(result['body'])['data']]
+
+
+def test_symbology_maps_results_by_request_id(monkeypatch):
+    # the API answers out of order and drops an id; every row still gets the
+    # result of its own id
+    prefix=uuid.uuid4().hex[:8]
+    ids=[prefix+'_A', prefix+'_B', prefix+'_C']
+    sent=[]
+    post_ids=factset_symbology_post.post_ids
+
+    def reordered_post_ids(session, url, chunk, headers, timeout):
+        sent.extend(chunk)
+        data, response_time_ms = post_ids(session, url, chunk, headers, timeout)
+        return [result for result in reversed(data) if result['requestId'] != ids[1]], response_time_ms
+
+    monkeypatch.setattr(factset_symbology_post, 'post_ids', reordered_post_ids)
+
+    rows=[[0, ids[0]], [1, ids[1]], [2, ids[2]], [3, ids[0]], [4, None]]
+    outputs=call(factset_symbology_post.lambda_handler, rows)
+
+    # duplicate ids are requested once, null ids never
+    assert sorted(sent) == sorted(ids)
+
+    assert outputs[0]['response']['requestId'] == ids[0]
+    assert outputs[1]['error'] == "requestId not found"
+    assert outputs[2]['response']['requestId'] == ids[2]
+    assert outputs[3]['response'] == outputs[0]['response']
+    assert outputs[4]['error'] == "id is null"
+    assert [output['rowIndex'] for output in outputs] == [0, 1, 2, 3, 4]
+
+
+def test_symbology_resolved_ids_are_cached(monkeypatch):
+    prefix=uuid.uuid4().hex[:8]
+    rows=[[0, prefix+'_A'], [1, prefix+'_B']]
+    first=call(factset_symbology_post.lambda_handler, rows)
+
+    sent=[]
+    post_ids=factset_symbology_post.post_ids
+
+    def counting_post_ids(session, url, chunk, headers, timeout):
+        sent.extend(chunk)
+        return post_ids(session, url, chunk, headers, timeout)
+
+    monkeypatch.setattr(factset_symbology_post, 'post_ids', counting_post_ids)
+    second=call(factset_symbology_post.lambda_handler, rows)
+
+    assert sent == []
+    assert [output['response'] for output in second] == [output['response'] for output in first]
+
+
+def task_rows():
+    prefix=uuid.uuid4().hex[:8]
+    return [[i, prefix+' Company '+str(i), 'US', None, 'www.example.com'] for i in range(0,5)]
+
+
+def test_task_post_replays_retried_batch():
+    rows=task_rows()
+    task_count=len(factset_stub.tasks)
+
+    status_code, first, debug = factset_concordance_task_post.post_task(rows)
+    assert status_code == 200 and not debug['task_replayed']
+
+    # a retry of the same batch gets the same task without a second upload
+    status_code, retry, debug = factset_concordance_task_post.post_task(rows)
+    assert status_code == 200 and debug['task_replayed']
+    assert retry.constants['taskId'] == first.constants['taskId']
+
+    # the task is found in the persistent store after a restart as well
+    factset_concordance_task_post.TASK_IDEMPOTENCY_CACHE.memory.clear()
+    status_code, restarted, debug = factset_concordance_task_post.post_task(rows)
+    assert status_code == 200 and debug['task_replayed']
+    assert restarted.constants['taskId'] == first.constants['taskId']
+
+    assert len(factset_stub.tasks) == task_count+1
+
+
+def test_task_post_concurrent_retry_waits_for_first_attempt(monkeypatch):
+    # the retry arrives while the first upload is still waiting for the API
+    monkeypatch.setattr(factset_stub, 'LATENCY_MS', 300)
+    rows=task_rows()
+    task_count=len(factset_stub.tasks)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results=list(executor.map(lambda attempt: factset_concordance_task_post.post_task(rows), range(0,2)))
+
+    assert len(factset_stub.tasks) == task_count+1
+    assert results[0][1].constants['taskId'] == results[1][1].constants['taskId']
+    assert sorted(debug['task_replayed'] for status_code, batch, debug in results) == [False, True]
+    assert factset_concordance_task_post._task_locks == {}
+
+
+def test_persistent_cache_keeps_expiry_of_disk_entries():
+    cache=factset_api.PersistentTTLCache('expiry_'+uuid.uuid4().hex[:8], 3600)
+    cache.put('key', 'value')
+    with cache.lock:
+        cache.connect().execute('UPDATE cache SET expires=? WHERE key=?', (time.time()+2, 'key'))
+        cache.connect().commit()
+
+    # an entry read from disk expires in memory when it expires on disk
+    cache.memory.clear()
+    assert cache.get('key') == 'value'
+    assert cache.memory.entries['key'][0] < time.time()+3
+
+
+def test_task_post_creates_new_task_for_other_rows():
+    status_code, first, debug = factset_concordance_task_post.post_task(task_rows())
+    status_code, second, debug = factset_concordance_task_post.post_task(task_rows())
+    assert second.constants['taskId'] != first.constants['taskId']
+    assert not debug['task_replayed']
+
+
+class LambdaContext:
+    def __init__(self, remaining_ms):
+        self.remaining_ms=remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def route(monkeypatch, row_count, context=None, latency_ms=100):
+    # every test starts from the same latency estimate
+    monkeypatch.setattr(factset_concordance_route_post, 'MATCH_LATENCY', factset_concordance_route_post.LatencyTracker(latency_ms))
+    prefix=uuid.uuid4().hex[:8]
+    rows=[[i, prefix+' Company '+str(i), 'US', None, 'www.example.com'] for i in range(0,row_count)]
+    result=factset_concordance_route_post.lambda_handler({'body': json.dumps({'data': rows})}, context)
+    assert result['statusCode'] == 200, result['body']
+    return [output[0] for row_number, output in json.loads(result['body'])['data']]
+
+
+def test_route_small_batch_is_matched(monkeypatch):
+    outputs=route(monkeypatch, 30)
+    assert [output['route'] for output in outputs] == ['MATCH']*30
+    assert all(output['mapStatus'] == 'MAPPED' and output['entityId'] for output in outputs)
+    # candidates of the second sub-batch refer to the position in the whole batch
+    assert [output['response'][0]['rowIndex'] for output in outputs] == list(range(0,30))
+
+
+def test_route_large_batch_is_posted_as_task(monkeypatch):
+    outputs=route(monkeypatch, 150)
+    assert [output['route'] for output in outputs] == ['TASK']*150
+    assert len(set(output['taskId'] for output in outputs)) == 1
+    assert [output['rowIndex'] for output in outputs] == list(range(0,150))
+
+
+def test_route_failed_sub_batch_falls_back_to_task(monkeypatch):
+    match_rows=factset_concordance_match_post.match_rows
+
+    def failing_match_rows(rows, timeout=None):
+        # the second sub-batch fails
+        if rows[0][0] == factset_concordance_match_post.MAX_BATCH_ROWS:
+            return 400, "entity-match failed", None
+        return match_rows(rows, timeout)
+
+    monkeypatch.setattr(factset_concordance_match_post, 'match_rows', failing_match_rows)
+    outputs=route(monkeypatch, 30)
+
+    sub_batch_size=factset_concordance_match_post.MAX_BATCH_ROWS
+    assert [output['route'] for output in outputs] == ['MATCH']*sub_batch_size+['TASK']*(30-sub_batch_size)
+    # the fallback rows are numbered by their position in the task
+    assert [output['rowIndex'] for output in outputs[sub_batch_size:]] == list(range(0,30-sub_batch_size))
+    # the failure counts as at least the penalty
+    assert factset_concordance_route_post.MATCH_LATENCY.get() > 100
+
+
+def test_route_slow_match_times_out_within_budget(monkeypatch):
+    # 1000ms of the remaining 2000ms are left for the match path, the API takes 1500ms
+    monkeypatch.setattr(factset_stub, 'LATENCY_MS', 1500)
+    begin_ts=time.time()
+    outputs=route(monkeypatch, 10, LambdaContext(2000))
+    elapsed_ms=(time.time()-begin_ts)*1000
+
+    assert [output['route'] for output in outputs] == ['TASK']*10
+    # the match request gave up after its timeout, only the task post took the full latency
+    assert elapsed_ms < 1000+1500+500
+    assert factset_concordance_route_post.MATCH_LATENCY.get() >= 1000
+
+
+def bulk(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['factset_concordance_bulk.py']+list(args)+['--chunk-size', '3', '--poll-interval', '0'])
+    factset_concordance_bulk.main()
+
+
+def test_bulk_resumes_after_crash(monkeypatch, tmp_path):
+    input_path=str(tmp_path/'companies.csv')
+    output_path=str(tmp_path/'concorded.csv')
+    prefix=uuid.uuid4().hex[:8]
+    with open(input_path, 'w', encoding='utf-8') as file:
+        file.write('name,country,state,url\n')
+        for i in range(0,7):
+            file.write(prefix+' Company '+str(i)+',US,,www.example.com\n')
+
+    # a failed decisions request only delays the task instead of failing it
+    get_decisions=factset_concordance_bulk.BulkConcordance.get_decisions
+    errors=[requests.exceptions.ConnectionError('connection reset')]
+
+    def flaky_get_decisions(self, task_id, row_count):
+        # the last chunk of a single row is decided and written last
+        if errors and row_count == 1:
+            raise errors.pop()
+        return get_decisions(self, task_id, row_count)
+
+    monkeypatch.setattr(factset_concordance_bulk.BulkConcordance, 'get_decisions', flaky_get_decisions)
+    bulk(monkeypatch, input_path, output_path)
+
+    with open(output_path, newline='', encoding='utf-8') as file:
+        completed=file.read()
+    lines=completed.splitlines()
+    assert errors == []
+    assert [line.split(',')[0] for line in lines[1:]] == [str(i) for i in range(0,7)]
+    assert all(line.split(',')[7] == 'COMPLETED' for line in lines[1:])
+
+    # crash while the last chunk was being written: the checkpoint still has it
+    # as submitted and the output ends in a partial row
+    with open(output_path+'.checkpoint', encoding='utf-8') as file:
+        state=json.load(file)
+    assert all(chunk['status'] == 'COMPLETED' for chunk in state['chunks'].values())
+    state['chunks']['6']['status']='SUBMITTED'
+    state['output_size']=len(completed[:completed.rindex('\n', 0, -1)+1].encode('utf-8'))
+    with open(output_path+'.checkpoint', 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    with open(output_path, 'a', encoding='utf-8') as file:
+        file.write('6,'+prefix+' Comp')
+
+    task_count=len(factset_stub.tasks)
+    bulk(monkeypatch, input_path, output_path)
+
+    # the submitted chunk is polled again, not uploaded a second time, and the
+    # partial row is replaced
+    assert len(factset_stub.tasks) == task_count
+    with open(output_path, newline='', encoding='utf-8') as file:
+        assert file.read() == completed
+
+
+def decision_rows(monkeypatch, fail_status=False):
+    # posts a task and returns the rows of a decision request for it and the urls
+    # of all GET requests sent by the handler
+    rows=task_rows()
+    status_code, task, debug = factset_concordance_task_post.post_task(rows)
+    rows=[row+[task.constants['taskId'], i] for i, row in enumerate(rows)]
+
+    session=factset_api.get_session(json.loads(factset_api.get_secret()))
+    get=session.get
+    urls=[]
+
+    def recording_get(url, **kwargs):
+        urls.append(url)
+        if fail_status and url.endswith('/entity-task-status'):
+            raise requests.exceptions.ConnectionError('connection reset')
+        return get(url, **kwargs)
+
+    monkeypatch.setattr(session, 'get', recording_get)
+    return rows, urls
+
+
+def test_decisions_of_unfinished_task_are_not_downloaded(monkeypatch):
+    monkeypatch.setattr(factset_stub, 'TASK_MS', 60000)
+    rows, urls = decision_rows(monkeypatch)
+    outputs=[output['response'][0] for output in call(factset_concordance_task_decision_get.lambda_handler, rows)]
+
+    assert all(output['taskStatus'] == 'IN_PROGRESS' and output['progress'] < 100 for output in outputs)
+    assert all('mapStatus' not in output for output in outputs)
+    assert not any(url.endswith('/entity-decisions') for url in urls)
+
+
+def test_failed_task_returns_error(monkeypatch):
+    rows, urls = decision_rows(monkeypatch)
+    monkeypatch.setattr(factset_concordance_task_decision_get, 'get_task_status',
+        lambda session, task_id, headers, timeout: ({'taskId': task_id, 'status': 'FAILED'}, 0))
+    outputs=[output['response'][0] for output in call(factset_concordance_task_decision_get.lambda_handler, rows)]
+
+    assert all(output['error'] == "Task ended with status FAILED" for output in outputs)
+    assert all('mapStatus' not in output for output in outputs)
+    assert not any(url.endswith('/entity-decisions') for url in urls)
+
+
+def test_decisions_are_downloaded_if_task_status_fails(monkeypatch):
+    rows, urls = decision_rows(monkeypatch, fail_status=True)
+    outputs=[output['response'][0] for output in call(factset_concordance_task_decision_get.lambda_handler, rows)]
+
+    assert [output['mapStatus'] for output in outputs] == ['MAPPED']*len(rows)
+    assert [output['name'] for output in outputs] == [row[1] for row in rows]
+    assert any(url.endswith('/entity-task-status') for url in urls)